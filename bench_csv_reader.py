@@ -0,0 +1,96 @@
+import os
+import csv
+import sys
+import time
+import random
+import tempfile
+from collections import defaultdict
+
+from csv_reader import iter_projected_csv, POST_COLUMNS, COMMENT_COLUMNS
+
+# the column layout xml_to_csv.py writes for Posts.xml
+SYNTHETIC_COLUMNS = [
+    "Id", "PostTypeId", "AcceptedAnswerId", "CreationDate", "Score", "ViewCount", "Body", "OwnerUserId",
+    "LastEditorUserId", "LastEditorDisplayName", "LastEditDate", "LastActivityDate", "Title", "Tags", "AnswerCount",
+    "CommentCount", "FavoriteCount", "CommunityOwnedDate", "ContentLicense", "ParentId", "BodyParsed", "TitleParsed",
+]
+
+
+def dict_reader_iter(file):
+    """the csv path of QA_Pairer.make_iter before csv_reader.py, kept for comparison"""
+    with open(file, 'r') as f:
+        f = (line.replace('\0', '') for line in f)
+        reader = csv.DictReader(f)
+        for row in reader:
+            record = defaultdict(lambda: None, {k: None if v == '' else v for k, v in row.items()})
+            yield record
+
+
+def write_synthetic_posts(path, num_rows, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, SYNTHETIC_COLUMNS)
+        writer.writeheader()
+        for i in range(1, num_rows + 1):
+            words = [rng.choice(['foo', 'bar', 'baz', 'x = 1', '"quoted"', 'a,b']) for _ in range(rng.randint(10, 300))]
+            body = '\n\n'.join(' '.join(words[j:j + 60]) for j in range(0, len(words), 60))
+            row = {
+                "Id": i, "PostTypeId": rng.choice(["1", "2"]), "CreationDate": "2008-07-31T21:42:52.667",
+                "Score": rng.randint(-5, 100), "ViewCount": rng.randint(0, 10000), "Body": f"<p>{body}</p>",
+                "BodyParsed": body, "OwnerUserId": rng.randint(1, 10000), "LastActivityDate": "2019-07-31T21:42:52.667",
+                "ContentLicense": "CC BY-SA 4.0",
+            }
+            if row["PostTypeId"] == "1":
+                row.update({"Title": f"title {i}", "TitleParsed": f"title {i}", "Tags": "<python><csv>",
+                            "AnswerCount": rng.randint(0, 5), "CommentCount": rng.randint(0, 5)})
+            else:
+                row["ParentId"] = rng.randint(1, i)
+            if i % 1000 == 0:
+                row["Body"] += '\0'
+            writer.writerow(row)
+
+
+def time_reader(name, records):
+    start = time.time()
+    count = 0
+    for _ in records:
+        count += 1
+    elapsed = time.time() - start
+    print(f"{name}:\t{count:_} rows in {elapsed:.2f}s\t({count / elapsed:_.0f} rows/s)")
+    return elapsed
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='benchmark csv_reader.iter_projected_csv against the csv.DictReader path '
+                                                 'QA_Pairer used to use')
+    parser.add_argument('csv_file', nargs='?', help='Posts.csv or Comments.csv written by xml_to_csv.py. If not given, '
+                                                    'a synthetic Posts.csv is generated')
+    parser.add_argument('--synthetic_rows', type=int, default=200_000)
+    parser.add_argument('--check', action='store_true', help='also check that both readers give the same records')
+    args = parser.parse_args()
+
+    csv.field_size_limit(sys.maxsize)
+
+    tmp_dir = None
+    if args.csv_file is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        csv_file = os.path.join(tmp_dir.name, "Posts.csv")
+        write_synthetic_posts(csv_file, args.synthetic_rows)
+    else:
+        csv_file = args.csv_file
+    columns = COMMENT_COLUMNS if "Comments" in os.path.basename(csv_file) else POST_COLUMNS
+    print(f"{csv_file}: {os.path.getsize(csv_file):_} bytes, projecting {columns}")
+
+    old = time_reader("DictReader", dict_reader_iter(csv_file))
+    new = time_reader("projected ", iter_projected_csv(csv_file, columns))
+    print(f"speedup: {old / new:.2f}x")
+
+    if args.check:
+        for old_record, new_record in zip(dict_reader_iter(csv_file), iter_projected_csv(csv_file, columns)):
+            expected = {k: v for k, v in old_record.items() if k in columns and v is not None}
+            assert expected == new_record, (expected, new_record)
+        print("records match")
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
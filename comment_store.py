@@ -0,0 +1,73 @@
+from array import array
+
+import numpy as np
+
+
+class CommentStore():
+
+    def __init__(self):
+        """
+        Compact in-memory store of comment texts by post id.
+
+        Texts are appended to one contiguous UTF-8 buffer, with their post ids and buffer offsets in integer arrays, so
+        that memory use is close to the size of the text itself rather than dominated by per-str and per-list
+        overhead. Once all comments are added, finalize() sorts the index by post id (keeping the order comments were
+        added in within a post) and lookups are a binary search. Texts are only decoded into strs when they're looked
+        up.
+        """
+        self.buffer = bytearray()
+        self._post_ids = array('q')
+        self._offsets = array('q', [0])
+        self.post_ids = None
+        self.starts = None
+        self.ends = None
+
+    def append(self, post_id, text):
+        assert self.post_ids is None, "can't add comments after finalize()"
+        self.buffer += text.encode('utf-8', 'surrogatepass')
+        self._post_ids.append(int(post_id))
+        self._offsets.append(len(self.buffer))
+
+    def finalize(self):
+        """sorts the comments by post id, after which they can be looked up"""
+        post_ids = np.frombuffer(self._post_ids, dtype=np.int64)
+        offsets = np.frombuffer(self._offsets, dtype=np.int64)
+        order = np.argsort(post_ids, kind='stable')
+        self.post_ids = post_ids[order]
+        self.starts = offsets[:-1][order]
+        self.ends = offsets[1:][order]
+        del post_ids, offsets
+        self._post_ids = None
+        self._offsets = None
+        return self
+
+    def get(self, post_id, limit=None):
+        """
+        :return: list of the texts of comments on post_id, in the order they were added
+        """
+        assert self.post_ids is not None, "call finalize() before looking up comments"
+        post_id = int(post_id)
+        lo = np.searchsorted(self.post_ids, post_id, side='left')
+        hi = np.searchsorted(self.post_ids, post_id, side='right')
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        view = memoryview(self.buffer)
+        return [str(view[start:end], 'utf-8', 'surrogatepass')
+                for start, end in zip(self.starts[lo:hi].tolist(), self.ends[lo:hi].tolist())]
+
+    def __getitem__(self, post_id):
+        return self.get(post_id)
+
+    def __len__(self):
+        if self.post_ids is not None:
+            return len(self.post_ids)
+        return len(self._post_ids)
+
+    @property
+    def nbytes(self):
+        """approximate memory used by the store"""
+        if self.post_ids is not None:
+            index_bytes = self.post_ids.nbytes + self.starts.nbytes + self.ends.nbytes
+        else:
+            index_bytes = (len(self._post_ids) + len(self._offsets)) * 8
+        return len(self.buffer) + index_bytes
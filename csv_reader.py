@@ -0,0 +1,90 @@
+import os
+import io
+import sys
+import csv
+from operator import itemgetter
+
+from utils import Record
+
+# columns of the csv files written by xml_to_csv.py that QA_Pairer reads. everything else is discarded by trim_attribs
+POST_COLUMNS = ["Id", "PostTypeId", "ParentId", "AcceptedAnswerId", "AnswerCount", "Score",
+                "Title", "TitleParsed", "Body", "BodyParsed", "Tags"]
+COMMENT_COLUMNS = ["PostId", "Text"]
+
+
+class NulStrippingReader(io.RawIOBase):
+    """
+    Wraps a binary file, dropping NUL bytes from each buffer as it is read.
+
+    Since NUL can only occur as the encoding of U+0000 in UTF-8, this is equivalent to removing '\\0' from the decoded
+    text, but is done once per buffer instead of once per line.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            data = self.raw.read(len(b))
+            if not data:
+                return 0
+            if b'\0' in data:
+                data = data.replace(b'\0', b'')
+            # a buffer consisting only of NULs would otherwise look like EOF
+            if data:
+                break
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+def iter_projected_csv(path, columns=None, buffer_size=1024 * 1024):
+    """
+    Yields a Record for each row of a csv file, containing only the given columns.
+
+    Empty values are left out of the record, so they read as None, matching QA_Pairer's previous csv handling. Columns
+    that are not in the file's header are ignored.
+
+    :param path: path to a csv file with a header row, or a binary file object to read it from (which is closed
+        when done)
+    :param columns: names of the columns to keep, or None to keep all of them
+    :param buffer_size: size of the read buffer in bytes
+    """
+    # post bodies can be larger than csv's default 128KB field limit
+    csv.field_size_limit(sys.maxsize)
+    raw = open(path, 'rb') if isinstance(path, (str, bytes, os.PathLike)) else path
+    with io.TextIOWrapper(io.BufferedReader(NulStrippingReader(raw), buffer_size), encoding='utf-8') as f:
+        reader = csv.reader(f)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return
+        if columns is None:
+            columns = header
+        names = [c for c in columns if c in header]
+        indices = [header.index(c) for c in names]
+        if not indices:
+            return
+        max_index = max(indices)
+        if len(indices) == 1:
+            # itemgetter returns a bare value rather than a tuple for a single index
+            index = indices[0]
+            getter = lambda row: (row[index],)
+        else:
+            getter = itemgetter(*indices)
+        for row in reader:
+            if not row:
+                continue
+            if len(row) > max_index:
+                values = getter(row)
+            else:
+                # short (malformed) row: missing trailing fields read as empty
+                values = [row[i] if i < len(row) else '' for i in indices]
+            yield Record({k: v for k, v in zip(names, values) if v})
@@ -1,3 +1,4 @@
+import shutil
 import requests
 from bs4 import BeautifulSoup
 from utils import *
@@ -6,58 +7,103 @@ import py7zr
 
 class Stack_Exchange_Downloader():
 
-    def __init__(self, name):
+    sitesmap_url = "https://ia600107.us.archive.org/27/items/stackexchange/Sites.xml"
+    download_url = "https://archive.org/download/stackexchange"
+
+    def __init__(self, name, in_folder="dumps", mirror=None):
         """
         :param name: name of stackexchange site to download. If all, will download all stackexchanges & metas.
+        :param in_folder: folder to download and extract dumps to
+        :param mirror: base URL or local folder holding Sites.xml and the .7z dumps, to use instead of archive.org
         """
-        sitesmap = requests.get("https://ia600107.us.archive.org/27/items/stackexchange/Sites.xml").content
+        self.in_folder = in_folder
+        self.mirror = mirror
+        if mirror is None:
+            sitesmap = requests.get(self.sitesmap_url).content
+        elif os.path.isdir(mirror):
+            with open(os.path.join(mirror, "Sites.xml"), 'rb') as f:
+                sitesmap = f.read()
+        else:
+            sitesmap = requests.get(mirror.rstrip('/') + "/Sites.xml").content
         self.name = name.replace("http://", "").replace("https://", "").replace(".com", "").replace(".net", "")
         self.sites = {}
         self.parse_sitesmap(sitesmap)
 
     def parse_sitesmap(self, sitesmap):
+        if self.mirror is None:
+            base_url = self.download_url
+        else:
+            base_url = self.mirror.rstrip('/')
         soup = BeautifulSoup(sitesmap, "lxml")
         for site in soup.find_all("row"):
             url = site['url'].replace("https://", "")
             site_name = url.replace(".com", "").replace(".net", "")
-            download_link = "https://archive.org/download/stackexchange/" + url + ".7z"
+            archive = url + ".7z"
             if url == "stackoverflow.com":
-                download_link = "https://archive.org/download/stackexchange/stackoverflow.com-Posts.7z"
-            self.sites[site_name] = {"url" : url, "download" : download_link}
+                archive = "stackoverflow.com-Posts.7z"
+            self.sites[site_name] = {"url" : url, "archive": archive, "download" : base_url + "/" + archive}
+
+    def archive_path(self, name):
+        return os.path.join(self.in_folder, self.sites[name]["archive"])
+
+    def download_site(self, name):
+        """downloads (or copies from a local mirror) the 7z dump of a site, raising DownloadError if that fails"""
+        archive_path = self.archive_path(name)
+        if self.mirror is not None and os.path.isdir(self.mirror):
+            print("copying {} to {}".format(self.sites[name]["download"], self.in_folder))
+            try:
+                shutil.copy(self.sites[name]["download"], self.in_folder)
+            except OSError as e:
+                self._remove(archive_path)
+                raise DownloadError('Download for {} failed: {}'.format(name, e)) from e
+            return
+        command = "wget {} -P {}".format(self.sites[name]["download"], self.in_folder)
+        print(command)
+        if os.system(command):
+            # so that a partial download isn't taken for a complete one next time
+            self._remove(archive_path)
+            raise DownloadError('Download for {} failed!'.format(name))
+
+    def extract_site(self, name):
+        """extracts the 7z dump of a site, raising DownloadError if that fails"""
+        # archive = py7zr.SevenZipFile(self.archive_path(name), mode='r')
+        # archive.extractall()
+        # archive.close()
+        out_folder = os.path.join(self.in_folder, name)
+        command = "py7zr x {} {}".format(self.archive_path(name), out_folder)
+        print(command)
+        if os.system(command):
+            # so that partially extracted files aren't taken for a complete dump next time
+            shutil.rmtree(out_folder, ignore_errors=True)
+            raise DownloadError('Extraction for {} failed!'.format(name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
     def download(self):
         if self.name == "all":
             for k in self.sites:
-                command = "wget {} -P dumps".format(self.sites[k]["download"])
-                print(command)
-                if os.system(command):
-                    print('Download for {} failed!'.format(k))
+                try:
+                    self.download_site(k)
+                except DownloadError as e:
+                    print(e)
         else:
-            command = "wget {} -P dumps".format(self.sites[self.name]["download"])
-            print(command)
-            if os.system(command):
-                print('Download for {} failed!'.format(self.name))
+            self.download_site(self.name)
 
     def extract(self):
         if self.name == "all":
             for k in self.sites:
-                # archive = py7zr.SevenZipFile('dumps/{}'.format(self.sites[k]["download"].replace("https://archive.org/download/stackexchange/", "")
-                #                                                , mode='r'))
-                # archive.extractall()
-                # archive.close()
-                command = "py7zr x dumps/{} dumps/{}".format(self.sites[k]["download"].replace("https://archive.org/download/stackexchange/", ""),
-                                                       k)
-                print(command)
-                if os.system(command):
-                    print('Extraction for {} failed!'.format(k))
+                try:
+                    self.extract_site(k)
+                except DownloadError as e:
+                    print(e)
         else:
-            # archive = py7zr.SevenZipFile(
-            #     'dumps/{}'.format(self.sites[self.name]["download"].replace("https://archive.org/download/stackexchange/", "")
-            #                       , mode='r'))
-            # archive.extractall()
-            # archive.close()
-            command = "py7zr x dumps/{} dumps/{}".format(self.sites[self.name]["download"].replace("https://archive.org/download/stackexchange/", ""),
-                                                      self.name)
-            print(command)
-            if os.system(command):
-                print('Extraction for {} failed!'.format(self.name))
+            self.extract_site(self.name)
+
+
+class DownloadError(Exception):
+    pass
@@ -5,68 +5,147 @@ from multiprocessing import Pool, cpu_count
 from utils import *
 from downloader import Stack_Exchange_Downloader
 from pairer import QA_Pairer
+from shards import ShardWriter
+from tag_index import TagIndex
+from tokenization import add_tokenizer_args, get_tokenizer, get_token_cache
+from sharding import ShardPlan
+from pipeline import run_pipeline
+from metrics import MetricsReporter
+from work_queue import WorkQueue, Lease, default_worker_id
 import os
+import fcntl
+import shutil
+import filecmp
+from contextlib import contextmanager
 from itertools import repeat
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from lm_dataformat import Archive
 import zipfile
 
 
-def download_and_process_single(name, args):
+# Stack_Exchange_Downloaders by (in_folder, mirror), so that Sites.xml is only fetched once per process
+_downloaders = {}
+
+
+def get_downloader(args):
+    key = (args.in_folder, args.mirror)
+    if key not in _downloaders:
+        _downloaders[key] = Stack_Exchange_Downloader("all", in_folder=args.in_folder, mirror=args.mirror)
+    return _downloaders[key]
+
+
+def needs_tokenizer(args):
+    return args.count_tokens or args.out_format == 'fairseq' or args.max_tokens is not None
+
+
+def init_worker(args, downloader=None):
+    """
+    initializer for the processes parsing sites, which loads the resources shared by every site up front: the
+    tokenizer, if one is needed, and the sites map.
+
+    :param downloader: a Stack_Exchange_Downloader already made by the parent process, to reuse its sites map instead
+        of fetching Sites.xml again in every worker
+    """
+    if downloader is not None:
+        _downloaders.setdefault((args.in_folder, args.mirror), downloader)
+    if needs_tokenizer(args):
+        get_tokenizer(args)
+
+
+def needs_download(name, args):
+    name = name.strip().lower()
+    return not os.path.isfile("{}/{}/Posts.{}".format(args.in_folder, name, args.in_format))
+
+
+def download_single(name, args):
+    """downloads the 7z dump of a site, unless it has already been downloaded or extracted"""
+    name = name.strip().lower()
+    os.makedirs(args.in_folder, exist_ok=True)
+    if needs_download(name, args):
+        s = get_downloader(args)
+        if not os.path.isfile(s.archive_path(name)):
+            s.download_site(name)
+
+
+def extract_single(name, args):
+    """extracts the 7z dump of a site, unless it has already been extracted"""
+    if needs_download(name, args):
+        get_downloader(args).extract_site(name.strip().lower())
+
+
+def process_single(name, args, cancel=None):
+    """
+    pairs questions and answers of an extracted site and writes them in args.out_format
+
+    :param cancel: optional threading.Event which stops processing once it is set, see QA_Pairer
+    """
     out_format = args.out_format
     min_score = args.min_score
     max_responses = args.max_responses
-    try:
-        name = name.strip().lower()
-        os.makedirs(args.in_folder, exist_ok=True)
-        path_to_posts = "{}/{}/Posts.{}".format(args.in_folder, name, args.in_format)
-        path_to_comments = "{}/{}/Comments.{}".format(args.in_folder, name, args.in_format)
-        out_folder = args.out_folder
-        os.makedirs(out_folder, exist_ok=True)
-        if not os.path.isfile(path_to_posts):
-            # extract 7z if it's not extracted already
-            s = Stack_Exchange_Downloader(name)
-            if name != "stackoverflow":
-                path_to_7z = "{}/{}.7z".format(args.in_folder, s.sites[name]["url"])
-            else:
-                path_to_7z = "{}/stackoverflow.com-Posts.7z".format(args.in_folder)
-            if not os.path.isfile(path_to_7z):
-                # download 7z if it's not downloaded already
-                s.download()
-            s.extract()
-        if out_format == "lm_dataformat":
-            archiver = Archive(out_folder)
-        elif out_format == "zip":
-            archiver = zipfile.ZipFile('{}/{}.zip'.format(out_folder, name), 'a')
-        elif out_format == "fairseq":
-            if args.num_shards is not None and args.shard_number is not None:
-                suffix = f"_{args.shard_number}"
-            else:
-                suffix = ""
-
-            raw_folder = os.path.join(out_folder, "raw")
-            os.makedirs(raw_folder, exist_ok=True)
-            raw_fname = os.path.join(raw_folder, f"{name}{suffix}.raw")
+    name = name.strip().lower()
+    path_to_posts = "{}/{}/Posts.{}".format(args.in_folder, name, args.in_format)
+    path_to_comments = "{}/{}/Comments.{}".format(args.in_folder, name, args.in_format)
+    out_folder = args.out_folder
+    os.makedirs(out_folder, exist_ok=True)
+    if args.shard_plan_folder is not None:
+        assert args.shard_number is not None, "--shard_plan_folder requires --shard_number"
+        shard_plan = ShardPlan.load(ShardPlan.plan_path(args.shard_plan_folder, name))
+    else:
+        shard_plan = None
+    if args.shard_number is not None and (args.num_shards is not None or shard_plan is not None):
+        suffix = f"_{args.shard_number}"
+    else:
+        suffix = ""
+    if args.slow_path_folder is not None:
+        slow_path = os.path.join(args.slow_path_folder, f"{name}{suffix}.jsonl")
+    else:
+        slow_path = None
+    if args.process_slow_path:
+        assert slow_path is not None, "--process_slow_path requires --slow_path_folder"
+        if not os.path.exists(slow_path):
+            print(f"no deferred threads for {name}{suffix}")
+            return
+        # written alongside, rather than over, the output of the first pass
+        suffix = f"{suffix}_slow"
+    if out_format == "lm_dataformat":
+        archiver = Archive(out_folder)
+    elif out_format == "zip":
+        archiver = zipfile.ZipFile('{}/{}{}.zip'.format(out_folder, name, suffix), 'a')
+    elif out_format == "shards":
+        shards_folder = os.path.join(out_folder, "shards")
+        archiver = ShardWriter(shards_folder, f"{name}{suffix}",
+                               max_shard_bytes=args.max_shard_bytes, compress=args.compress_shards)
+    elif out_format == "fairseq":
+        raw_folder = os.path.join(out_folder, "raw")
+        os.makedirs(raw_folder, exist_ok=True)
+        raw_fname = os.path.join(raw_folder, f"{name}{suffix}.raw")
 
-            bpe_folder = os.path.join(out_folder, "bpe")
-            os.makedirs(bpe_folder, exist_ok=True)
-            bpe_fname = os.path.join(bpe_folder, f"{name}{suffix}.bpe")
+        bpe_folder = os.path.join(out_folder, "bpe")
+        os.makedirs(bpe_folder, exist_ok=True)
+        bpe_fname = os.path.join(bpe_folder, f"{name}{suffix}.bpe")
 
-            archiver = open(raw_fname, 'w'), open(bpe_fname, 'w')
-        else:
-            archiver = None
-        if args.count_tokens or out_format == 'fairseq':
-            from tokenizers import ByteLevelBPETokenizer
-
-            tokenizer = ByteLevelBPETokenizer.from_file(
-                '/checkpoint/dpf/data/tokenizers/github-py+so_psno-True/vocab.json',
-                '/checkpoint/dpf/data/tokenizers/github-py+so_psno-True/merges.txt',
-                pretokenizer_split_newlines_only=True
-                # args.tokenizer_vocab_file,
-                # args.tokenizer_merges_file,
-                # pretokenizer_split_newlines_only=args.tokenizer_split_newlines_only,
-            )
+        archiver = open(raw_fname, 'w'), open(bpe_fname, 'w')
+    else:
+        archiver = None
+    # closed whether or not processing succeeds, so that files are flushed and cached tokens are kept
+    index = None
+    token_cache = None
+    completed = False
+    try:
+        if args.build_index:
+            assert out_format == "shards", "--build_index requires --out_format shards"
+            index = TagIndex(os.path.join(shards_folder, f"{name}{suffix}{TagIndex.suffix}"))
+        if needs_tokenizer(args):
+            tokenizer = get_tokenizer(args)
+            token_cache = get_token_cache(args, tokenizer)
         else:
             tokenizer = None
+        if args.metrics_folder is not None:
+            metrics = MetricsReporter(os.path.join(args.metrics_folder, f"{name}{suffix}.jsonl"),
+                                      interval=args.metrics_interval)
+        else:
+            metrics = None
         qa = QA_Pairer(path_to_posts,
         name=name, 
         out_format=out_format, 
@@ -77,33 +156,157 @@ def download_and_process_single(name, args):
         max_responses=max_responses,
         max_comments=args.max_comments,
         min_score=min_score,
+        seed=args.seed,
         shard_number=args.shard_number,
         num_shards=args.num_shards,
+        shard_plan=shard_plan,
         tokenizer=tokenizer,
-        count_tokens=args.count_tokens)
-        qa.main()
+        count_tokens=args.count_tokens,
+        write_queue_size=args.write_queue_size,
+        index=index,
+        token_cache=token_cache,
+        metrics=metrics,
+        max_body_size=args.max_body_size,
+        max_parse_seconds=args.max_parse_seconds,
+        max_tokens=args.max_tokens,
+        oversize_policy=args.oversize_policy,
+        # the slow path is only read when processing it
+        slow_path=slow_path if not args.process_slow_path else None,
+        cancel=cancel)
+        if args.process_slow_path:
+            qa.main_deferred(slow_path)
+        else:
+            qa.main()
+        if args.stats_folder is not None:
+            os.makedirs(args.stats_folder, exist_ok=True)
+            qa.write_stats(os.path.join(args.stats_folder, f"{name}{suffix}.json"))
+        completed = True
+    finally:
         if out_format == "lm_dataformat":
-            archiver.commit(name)
-        elif out_format == "zip":
+            # named by shard, so that the shards of a site don't overwrite each other
+            if completed:
+                archiver.commit(f"{name}{suffix}")
+            # commit opens the next chunk, which stays empty
+            archiver.fh.close()
+        elif out_format in ["zip", "shards"]:
             archiver.close()
         elif out_format == "fairseq":
             for f in archiver:
                 f.close()
-        # try:
-        #     os.remove(path_to_7z)
-        # except FileNotFoundError:
-        #     print('ERROR: FileNotFoundError: File {} not found'.format(s.sites[name]["url"]))
-        # filelist = [f for f in os.listdir("dumps/{}".format(name)) if f.endswith(".xml")]
-        # for f in filelist:
-        #     os.remove(os.path.join("dumps/{}".format(name), f))
+        if index is not None:
+            index.close()
+        if token_cache is not None:
+            token_cache.close()
+    # try:
+    #     os.remove(path_to_7z)
+    # except FileNotFoundError:
+    #     print('ERROR: FileNotFoundError: File {} not found'.format(s.sites[name]["url"]))
+    # filelist = [f for f in os.listdir("dumps/{}".format(name)) if f.endswith(".xml")]
+    # for f in filelist:
+    #     os.remove(os.path.join("dumps/{}".format(name), f))
+
+
+def download_and_process_single(name, args):
+    try:
+        download_single(name, args)
+        extract_single(name, args)
+        process_single(name, args)
     except:
         traceback.print_exc()
 
 
+@contextmanager
+def site_lock(in_folder, name):
+    """
+    holds an exclusive lock on a site's dump in in_folder, so that workers processing different shards of a site don't
+    download or extract it at the same time
+    """
+    os.makedirs(in_folder, exist_ok=True)
+    with open(os.path.join(in_folder, f".{name}.lock"), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def move_into(src_folder, dst_folder):
+    """
+    moves every file under src_folder to the same relative path under dst_folder.
+
+    Files are never replaced: a file identical to the one already in dst_folder, e.g. from a rerun of the same shard, is
+    dropped, and a different one raises FileExistsError, before anything is moved if it was already there. Files are
+    hard linked into place, so that two workers publishing the same path at once can't overwrite each other either.
+    """
+    moves = []
+    for root, _, files in os.walk(src_folder):
+        target = os.path.normpath(os.path.join(dst_folder, os.path.relpath(root, src_folder)))
+        for fname in files:
+            if fname == "current_chunk_incomplete":
+                # lm_dataformat's empty next chunk, not output
+                continue
+            src, dst = os.path.join(root, fname), os.path.join(target, fname)
+            if os.path.exists(dst):
+                if not filecmp.cmp(src, dst, shallow=False):
+                    raise FileExistsError(f"{dst} already exists with different contents")
+                continue
+            moves.append((src, dst))
+    for src, dst in moves:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.link(src, dst)
+        os.remove(src)
+
+
+def run_worker(args):
+    """
+    claims (site, shard) tasks from the work queue and processes them until there are none left.
+
+    Each attempt writes to its own folder under {out_folder}/.attempts, which is only moved into out_folder while the
+    lease is still held. So an attempt that fails, or loses its lease to another worker, never leaves partial or
+    duplicate output behind, and a retry doesn't append to it.
+    """
+    queue = WorkQueue(args.work_queue, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    worker = args.worker_id or default_worker_id()
+    init_worker(args)
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            break
+        print(f"{worker}: processing {task.site} shard {task.shard} (attempt {task.attempt})")
+        task_args = argparse.Namespace(**vars(args))
+        if task.num_shards is not None:
+            task_args.shard_number = task.shard
+            task_args.num_shards = task.num_shards
+        attempt_folder = os.path.join(args.out_folder, ".attempts", f"{task.site}_{task.shard}_{task.attempt}_{worker}")
+        shutil.rmtree(attempt_folder, ignore_errors=True)
+        task_args.out_folder = attempt_folder
+        try:
+            with Lease(queue, task, worker) as lease:
+                with site_lock(args.in_folder, task.site):
+                    download_single(task.site, task_args)
+                    extract_single(task.site, task_args)
+                process_single(task.site, task_args, cancel=lease.lost)
+                lease.check(queue)
+                move_into(attempt_folder, args.out_folder)
+                # completed while still heartbeating, so the lease can't expire in between
+                if not queue.complete(task, worker):
+                    print(f"{worker}: lost the lease on {task.site} shard {task.shard} after publishing its output")
+        except Exception:
+            traceback.print_exc()
+            queue.fail(task, worker, traceback.format_exc())
+        finally:
+            shutil.rmtree(attempt_folder, ignore_errors=True)
+    print(f"{worker}: no tasks left")
+    queue.close()
+
+
 def main(args):
+    if args.work_queue is not None:
+        run_worker(args)
+        return
     names = args.names.split(',')
     if names[0].strip().lower() == "all":
-        s = Stack_Exchange_Downloader("all")
+        s = get_downloader(args)
         names = []
         for k in s.sites:
             names.append(k)
@@ -111,11 +314,29 @@ def main(args):
         if "stackoverflow" in names:
             names.insert(0, names.pop(names.index("stackoverflow")))
     print('Downloading and processing stackexchange dumps for {}'.format(names))
+    # fetch the sites map before starting any workers, which are then given it rather than each fetching their own
+    if any(needs_download(name, args) for name in names):
+        get_downloader(args)
+    initargs = (args, _downloaders.get((args.in_folder, args.mirror)))
     # Download & Process
+    if args.pipeline:
+        # overlap downloading, extracting and processing of different sites, each stage with its own pool
+        process_workers = args.process_workers or max(cpu_count() - 1, 1)
+        max_in_flight = args.max_sites_in_flight or (args.download_workers + args.extract_workers + process_workers)
+        with ThreadPoolExecutor(args.download_workers) as download_pool, \
+                ThreadPoolExecutor(args.extract_workers) as extract_pool, \
+                ProcessPoolExecutor(process_workers, initializer=init_worker, initargs=initargs) as process_pool:
+            failures = run_pipeline(names, [
+                ("download", partial(download_single, args=args), download_pool),
+                ("extract", partial(extract_single, args=args), extract_pool),
+                ("process", partial(process_single, args=args), process_pool),
+            ], max_in_flight=max_in_flight)
+        if failures:
+            print("failed: {}".format(', '.join(f"{name} ({stage})" for name, stage in failures)))
     # init pool with as many CPUs as available
-    if len(names) > 1:
-        cpu_no = cpu_count() - 1
-        p = Pool(cpu_no)
+    elif len(names) > 1:
+        cpu_no = max(cpu_count() - 1, 1)
+        p = Pool(cpu_no, initializer=init_worker, initargs=initargs)
         #p.starmap(download_and_process_single, zip(names, repeat(args.out_format), repeat(args.min_score), repeat(args.max_responses), repeat(args))
         p.starmap(download_and_process_single, zip(names, repeat(args)))
     else:
@@ -135,9 +356,11 @@ if __name__ == "__main__":
                         choices=["xml", "csv"],
                         type=str)
     parser.add_argument('--out_format', help='format of out file - if you are processing everything this will need to be '
-                                             'lm_dataformat, as you will run into number of files per directory limits.',
+                                             'lm_dataformat or shards, as you will run into number of files per directory limits. '
+                                             'shards packs documents into size-rolled JSONL files with an offset index, '
+                                             'see shards.py',
                         default="lm_dataformat",
-                        choices=["txt", "lm_dataformat", "zip", "none", "fairseq"],
+                        choices=["txt", "lm_dataformat", "zip", "none", "fairseq", "shards"],
                         type=str)
     parser.add_argument('--min_score', help='minimum score of a response in order to be included in the dataset',
                         type=int, default=0)
@@ -145,12 +368,64 @@ if __name__ == "__main__":
     parser.add_argument('--max_comments', help='maximum number of comments (sorted consecutively by post time) to include for each question/answer', type=int, default=5)
     parser.add_argument('--num_shards', type=int)
     parser.add_argument('--shard_number', type=int)
+    parser.add_argument('--shard_plan_folder', help='folder of {name}.plan.json files written by sharding.py plan. '
+                                                    'Shards are then balanced by estimated output size rather than '
+                                                    'having equal numbers of questions')
+    parser.add_argument('--stats_folder', help='write question / answer / tag / token counts for each site and shard to '
+                                               'json files in this folder, which sharding.py merge can combine')
     parser.add_argument('--count_tokens', action='store_true')
+    parser.add_argument('--seed', help='seed for tag shuffling and attribute placement. Each thread is rendered with '
+                                       'its own rng derived from this seed, the site name and the question Id',
+                        type=int, default=0)
+    parser.add_argument('--write_queue_size', help='maximum number of documents waiting to be written by the background '
+                                                   'writer thread. 0 writes synchronously on the parsing thread',
+                        type=int, default=1024)
+    parser.add_argument('--max_shard_bytes', help='with --out_format shards, start a new shard once the current one '
+                                                  'reaches this many bytes', type=int, default=256 * 1024 * 1024)
+    parser.add_argument('--compress_shards', help='with --out_format shards, zstd-compress every document',
+                        action='store_true')
+    parser.add_argument('--build_index', help='with --out_format shards, also write a tag / site / score index of the '
+                                              'documents that tag_index.py can query', action='store_true')
+    parser.add_argument('--mirror', help='base URL or local folder to download Sites.xml and the 7z dumps from, '
+                                         'instead of archive.org')
+    parser.add_argument('--pipeline', help='download, extract and process sites in overlapping stages, each with its '
+                                           'own worker pool', action='store_true')
+    parser.add_argument('--download_workers', help='with --pipeline, number of concurrent downloads', type=int, default=2)
+    parser.add_argument('--extract_workers', help='with --pipeline, number of concurrent extractions', type=int, default=2)
+    parser.add_argument('--process_workers', help='with --pipeline, number of processes parsing sites (default: number '
+                                                  'of CPUs - 1)', type=int)
+    parser.add_argument('--max_sites_in_flight', help='with --pipeline, maximum number of sites downloaded or being '
+                                                      'downloaded but not yet processed (default: total number of '
+                                                      'workers)', type=int)
+    parser.add_argument('--metrics_folder', help='periodically append progress and memory metrics for each site and '
+                                                 'shard to a json lines file in this folder. python metrics.py '
+                                                 '<folder> summarizes them')
+    parser.add_argument('--metrics_interval', help='seconds between metrics reports', type=float, default=30)
+    parser.add_argument('--max_body_size', help='maximum number of characters in a post body (html, for xml input)',
+                        type=int)
+    parser.add_argument('--max_parse_seconds', help='maximum time to parse the html of a post. Parsing is '
+                        'interrupted with SIGALRM, which also works in pool workers since they run sites on their main '
+                        'thread', type=float)
+    parser.add_argument('--max_tokens', help='maximum number of tokens in a rendered question and its answers', type=int)
+    parser.add_argument('--oversize_policy', help='what to do with a post over one of the limits above: truncate it '
+                        '(or fall back to stripping html tags with a regex, for parse time), skip it, or defer its '
+                        'thread to --slow_path_folder', choices=["truncate", "skip", "defer"], default="truncate")
+    parser.add_argument('--slow_path_folder', help='with --oversize_policy defer, folder of {name}.jsonl files of '
+                        'deferred threads')
+    parser.add_argument('--process_slow_path', help='render the threads in --slow_path_folder without limits, instead '
+                        'of the dumps', action='store_true')
+    parser.add_argument('--work_queue', help='SQLite file of (site, shard) tasks made by work_queue.py init. Instead of '
+                        'processing --names, claim and process tasks from it until there are none left. Run any '
+                        'number of workers, on any machines that can see the file and share --out_folder')
+    parser.add_argument('--worker_id', help='with --work_queue, name of this worker (default: hostname:pid)')
+    parser.add_argument('--lease_seconds', help='with --work_queue, seconds without a heartbeat after which a task is '
+                        'handed to another worker', type=float, default=600)
+    parser.add_argument('--max_attempts', help='with --work_queue, number of times a task is tried before it is marked '
+                        'failed', type=int, default=3)
     parser.add_argument('--out_folder', default='out')
     parser.add_argument('--in_folder', default='dumps')
-    # parser.add_argument('--tokenizer_vocab_file', type=str, default='/checkpoint/dpf/data/tokenizers/github-py+so_psno-True/vocab.json')
-    # parser.add_argument('--tokenizer_merges_file', type=str, default='/checkpoint/dpf/data/tokenizers/github-py+so_psno-True/merges.txt')
-    # parser.add_argument('--tokenizer_split_newlines_only', action='store_true')
+    # tokenizer for --count_tokens, --max_tokens and --out_format fairseq
+    add_tokenizer_args(parser)
 
     print(' '.join(sys.argv))
     args = parser.parse_args()
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import resource
+
+
+def current_rss():
+    """resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # no /proc (e.g. macOS): fall back to the peak RSS, which is in kilobytes on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+class MetricsReporter():
+
+    def __init__(self, path, interval=30.0):
+        """
+        Appends a JSON line of progress and resource metrics to path every interval seconds, so that stalls and memory
+        blowups in long-running workers can be seen (and alerted on) while the job is running.
+
+        :param path: JSON lines file to append to, e.g. one per site and shard
+        :param interval: minimum number of seconds between reports
+        """
+        self.path = path
+        self.interval = interval
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.start_time = time.time()
+        self.last_time = None
+        self.last_rows = 0
+
+    def due(self):
+        return self.last_time is None or time.time() - self.last_time >= self.interval
+
+    def report(self, metrics):
+        """
+        :param metrics: dict of metrics to write. If it has a 'rows_parsed' count, the rate since the last report is
+            added as 'rows_per_sec'
+        """
+        now = time.time()
+        line = {
+            'time': now,
+            'elapsed': now - self.start_time,
+            'pid': os.getpid(),
+            'rss': current_rss(),
+        }
+        line.update(metrics)
+        if 'rows_parsed' in metrics:
+            since = now - (self.last_time if self.last_time is not None else self.start_time)
+            line['rows_per_sec'] = (metrics['rows_parsed'] - self.last_rows) / since if since > 0 else 0.0
+            self.last_rows = metrics['rows_parsed']
+        self.last_time = now
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(line) + "\n")
+
+
+if __name__ == "__main__":
+    import glob
+    import argparse
+    parser = argparse.ArgumentParser(description='print the latest metrics written by each worker, '
+                                                 'e.g. watch python metrics.py out/metrics')
+    parser.add_argument('metrics_folder')
+    parser.add_argument('--stalled_after', type=float, default=600,
+                        help='flag workers that haven\'t reported for this many seconds')
+    args = parser.parse_args()
+
+    now = time.time()
+    for path in sorted(glob.glob(os.path.join(args.metrics_folder, "*.jsonl"))):
+        last = None
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    last = line
+        if last is None:
+            continue
+        m = json.loads(last)
+        status = "done" if m.get('done') else ("STALLED" if now - m['time'] > args.stalled_after else "running")
+        print(f"{os.path.basename(path)[:-len('.jsonl')]}\t{status}\t{m.get('phase', '')}\t"
+              f"rows {m.get('rows_parsed', 0):_} ({m.get('rows_per_sec', 0):_.0f}/s)\t"
+              f"threads {m.get('threads_emitted', 0):_}\tpending {m.get('pending_questions', 0):_}\t"
+              f"rss {m['rss'] / 2 ** 30:.2f}GiB")
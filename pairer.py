@@ -1,14 +1,18 @@
 import re
+import time
+import bisect
 import traceback
-import xml.etree.ElementTree as etree
 from collections import defaultdict, Counter
 from bs4 import BeautifulSoup, PageElement, NavigableString, CData, Tag
 from tqdm import tqdm
 import pprint
-import csv
+import json
 import numpy as np
 
 from utils import *
+from writer import AsyncWriter
+from csv_reader import POST_COLUMNS, COMMENT_COLUMNS
+from comment_store import CommentStore
 
 from typing import Set
 
@@ -36,10 +40,22 @@ class QA_Pairer():
                 max_comments=5,
                 min_score=3,
                 attribute_move_probability=0.5,
+                seed=0,
                 shard_number=None,
                 num_shards=None, 
+                shard_plan=None,
                 tokenizer=None,
-                count_tokens=False):
+                count_tokens=False,
+                write_queue_size=0,
+                index=None,
+                token_cache=None,
+                metrics=None,
+                max_body_size=None,
+                max_parse_seconds=None,
+                max_tokens=None,
+                oversize_policy="truncate",
+                slow_path=None,
+                cancel=None):
         """Makes a text dataset from StackExchange dumps"""
         self.post_path = post_path
         self.comment_path = comment_path
@@ -56,48 +72,101 @@ class QA_Pairer():
         self.max_responses = max_responses
         self.max_comments = max_comments
         self.attribute_move_probability = attribute_move_probability
+        # tag shuffling and attribute placement use an rng seeded from (seed, site, question Id), so a thread renders
+        # the same no matter which shard or worker processes it
+        self.seed = seed
         assert in_format in ["csv", "xml"], "In format not recognized"
         self.in_format = in_format
-        assert out_format in ["txt", "lm_dataformat", "zip", "none", "fairseq"], "Out format not recognized"
+        assert out_format in ["txt", "lm_dataformat", "zip", "none", "fairseq", "shards"], "Out format not recognized"
         self.out_format = out_format
-        if out_format in ["lm_dataformat", "zip", "fairseq"]:
+        if out_format in ["lm_dataformat", "zip", "fairseq", "shards"]:
             assert archiver is not None
             self.ar = archiver
+        # optional TagIndex, filled with the shard location and metadata of each document as it is written
+        if index is not None:
+            assert out_format == "shards", "indexing requires shards output"
+        self.index = index
 
         self.tag_counter = Counter()
 
         self.count_tokens = count_tokens
         self.tokenizer = tokenizer
+        # optional TokenCache wrapping tokenizer, consulted before encoding a document
+        self.token_cache = token_cache
         self.token_counter = Counter()
         self.token_count = 0
+        # token ids computed while rendering (for max_tokens or count_tokens), by document name, so that documents
+        # that are also encoded for output (fairseq, or iter_documents with token_ids) aren't encoded again. Filled by
+        # render_thread and emptied as the documents are written
+        self.reuse_token_ids = out_format == "fairseq"
+        self.token_ids_by_name = {}
 
         self.question_count = 0
         self.answer_count = 0
+        self.char_count = 0
+        self.bytes_written = 0
+        self.rows_parsed = 0
+
+        # optional MetricsReporter, periodically given the counts in metrics_dict()
+        self.metrics = metrics
+        self.phase = None
 
         self.shard_number = shard_number
         self.num_shards = num_shards
-
-        # either None or (if comment_path was passed) a dict Dict[PostId: str, (score: int, text: str)
+        # optional sharding.ShardPlan assigning question ids to size-balanced shards, used instead of splitting the
+        # question ids into equal counts
+        if shard_plan is not None:
+            assert shard_number is not None, "a shard plan requires a shard_number"
+            assert num_shards is None or num_shards == shard_plan.num_shards, "num_shards doesn't match the shard plan"
+        self.shard_plan = shard_plan
+
+        # if write_queue_size > 0, documents are written by a background thread so that output compression and disk
+        # writes overlap with parsing. It's only started once the comments are parsed, so that a failure before then
+        # doesn't leave the thread running
+        self.write_queue_size = write_queue_size
+        self.writer = None
+
+        # optional limits on the raw size (in characters) of a post body, the time to parse one, and the number of tokens
+        # in a rendered thread. A post over a limit is truncated, skipped, or its thread is deferred to the slow_path
+        # JSON lines file, to be rendered later by main_deferred. limit_counter counts what happened to them
+        self.max_body_size = max_body_size
+        self.max_parse_seconds = max_parse_seconds
+        if max_tokens is not None:
+            assert tokenizer is not None, "max_tokens requires a tokenizer"
+        self.max_tokens = max_tokens
+        assert oversize_policy in ["truncate", "skip", "defer"], "Oversize policy not recognized"
+        if oversize_policy == "defer":
+            assert slow_path is not None, "deferring oversized threads requires a slow_path"
+        self.oversize_policy = oversize_policy
+        self.slow_path = slow_path
+        self.slow_path_file = None
+        self.limit_counter = Counter()
+
+        # optional threading.Event; once it is set, parsing stops by raising Cancelled, e.g. when a work queue lease
+        # has been lost
+        self.cancel = cancel
+
+        # a CommentStore of comment texts by PostId
         self.comment_dict = self.parse_comments()
 
-    def make_iter(self, file):
-        if self.in_format == 'csv':
-            with open(file, 'r') as f:
-                f = (line.replace('\0', '') for line in f)
-                reader = csv.DictReader(f)
-                for row in reader:
-                    record = defaultdict(lambda: None, {k: None if v == '' else v for k, v in row.items()})
-                    yield record
-        else:
-            for event, elem in etree.iterparse(file, events=('end',)):
-                if elem.tag == 'row':
-                    record = defaultdict(lambda: None, elem.attrib)
-                    yield record
-                    elem.clear()
+        if write_queue_size > 0 and out_format != "none":
+            self.writer = AsyncWriter(self._write, max_queue_size=write_queue_size)
+
+    def make_iter(self, file, columns=None):
+        """
+        yields an attribute dict for each row of a posts or comments file
+
+        :param columns: for csv input, the only columns to read (default: all)
+        """
+        return iter_records(file, self.in_format, columns)
 
     def parse_comments(self):
-        comment_dict = defaultdict(list)
-        for record in tqdm(self.make_iter(self.comment_path), desc="Parsing {} comment file".format(self.name), ncols=120):
+        comment_dict = CommentStore()
+        # assigned up front so that metrics can report its size while it is filled
+        self.comment_dict = comment_dict
+        self.phase = "comments"
+        for record in tqdm(self.make_iter(self.comment_path, COMMENT_COLUMNS), desc="Parsing {} comment file".format(self.name), ncols=120):
+            self.count_row()
             text = record["Text"]
             if text is None:
                 continue
@@ -105,7 +174,10 @@ class QA_Pairer():
                 text = BeautifulSoup(text, "html.parser").get_text()
             text = self.remove_username_re.sub("", text)
             post_id = record["PostId"]
-            comment_dict[post_id].append(text)
+            if post_id is None:
+                continue
+            comment_dict.append(post_id, text)
+        comment_dict.finalize()
         self.comment_dict = comment_dict
         return comment_dict
 
@@ -121,16 +193,44 @@ class QA_Pairer():
 
         """
         os.makedirs(self.out_folder, exist_ok=True)
-        if self.shard_number is not None and self.num_shards is not None:
-            question_ids = [int(record["Id"]) for record in tqdm(self.make_iter(self.post_path), desc="Get post ids for sharding", ncols=120) if is_question(record)]
+        try:
+            for out_name, out_str, meta in self.iter_threads():
+                self.write(out_name, out_str, meta)
+        except BaseException:
+            self.abort()
+            raise
+        self.close()
+        self.finish()
+
+    def finish(self):
+        self.phase = "done"
+        if self.metrics is not None:
+            self.metrics.report(dict(self.metrics_dict(), done=True))
+        print("processing complete")
+        self.print_status()
+
+    def iter_threads(self):
+        """
+        parses the posts file, yielding (out_name, out_str, meta) for each question as soon as all of its answers have
+        been seen
+        """
+        if self.shard_plan is not None:
+            shard_question_ids = None
+        elif self.shard_number is not None and self.num_shards is not None:
+            question_ids = [int(record["Id"]) for record in tqdm(self.make_iter(self.post_path, POST_COLUMNS), desc="Get post ids for sharding", ncols=120) if is_question(record)]
             shard_question_ids = set(np.array_split(question_ids, self.num_shards)[self.shard_number])
         else:
             shard_question_ids = None
 
-        for record in tqdm(self.make_iter(self.post_path), desc="Parsing {} posts".format(self.name), ncols=120):
+        self.phase = "posts"
+        for record in tqdm(self.make_iter(self.post_path, POST_COLUMNS), desc="Parsing {} posts".format(self.name), ncols=120):
             # try:
+                self.count_row()
                 if is_question(record):
-                    if shard_question_ids is not None:
+                    if self.shard_plan is not None:
+                        if self.shard_plan.shard_of(int(record["Id"])) != self.shard_number:
+                            continue
+                    elif shard_question_ids is not None:
                         question_id = int(record["Id"])
                         if question_id not in shard_question_ids:
                             continue
@@ -146,16 +246,44 @@ class QA_Pairer():
                     # if the answer's score > min_score
                     # append the answer to the relevant question's OtherAnswers dict
                     self.add_answer(record)
-                    self.check_complete(record)
+                    thread = self.check_complete(record)
+                    if thread is not None:
+                        yield thread
             # except :
             #     traceback.print_exc()
-        print("processing complete")
-        self.print_status()
 
         if shard_question_ids is not None and len(shard_question_ids) != 0:
             print("warning: did not find {len(shard_question_ids)} questions ids that should have been in this shard (below):")
             print(' '.join(str(x) for x in sorted(shard_question_ids)))
 
+    def iter_documents(self, token_ids=False):
+        """
+        Yields each rendered document as its thread completes, instead of writing it to out_format, so that it can be
+        consumed in-process (or sent on to another process, see stream.py) while parsing continues.
+
+        :param token_ids: also encode each document with self.tokenizer
+        :return: generator of {'text': str, 'meta': {'name', 'site', 'id', 'tags', 'score', 'dscore'}} dicts, which
+            also have a 'token_ids' list if token_ids is set
+        """
+        assert not token_ids or self.tokenizer is not None, "token_ids requires a tokenizer"
+        self.reuse_token_ids = self.reuse_token_ids or token_ids
+        try:
+            for out_name, out_str, meta in self.iter_threads():
+                try:
+                    text = filter_newlines(out_str)
+                    text.encode('utf-8')
+                except UnicodeError:
+                    text = filter_newlines(handle_unicode_errors(out_str))
+                document = {'text': text, 'meta': dict(meta, name=out_name)}
+                if token_ids:
+                    document['token_ids'] = self.pop_token_ids(out_name, out_str, text)
+                yield document
+        except BaseException:
+            # including GeneratorExit, if the consumer stops early
+            self.abort()
+            raise
+        self.close()
+        self.finish()
 
     def is_above_threshold(self, a_attribs):
         """
@@ -173,8 +301,8 @@ class QA_Pairer():
     def add_answer(self, a_attribs):
         """
         Adds answer to its parent question in self.questions if it's either an accepted answer or above self.min_score.
-         If answer is an accepted answer, it gets appended to the AcceptedAnswer field, otherwise it gets appended to
-         OtherAnswers.
+         Only the max_responses highest scoring of these are kept (see keep_answer), so memory per pending question is
+         bounded however many answers it has.
 
          Also increments the question's 'ParsedAnswers' field. When ParsedAnswers = AnswerCount, the question is deleted
          from memory and saved to a text file.
@@ -182,22 +310,88 @@ class QA_Pairer():
         :param a_attribs: Answer's attribute dict
         """
         assert is_answer(a_attribs), "Must be an answer to add to parent"
-        if a_attribs is not None and self.questions[a_attribs["ParentId"]] is not None:
-            if is_accepted_answer(a_attribs, self.questions[a_attribs["ParentId"]]):
-                self.questions[a_attribs["ParentId"]]["Answers"][a_attribs["Id"]] = trim_attribs(a_attribs, "answer")
-                self.questions[a_attribs["ParentId"]]["ParsedAnswers"] += 1
-            elif self.is_above_threshold(a_attribs):
-                if a_attribs["Id"] is not None:
-                    parent = self.questions[a_attribs["ParentId"]]
-                    if parent is not None:
-                        self.questions[a_attribs["ParentId"]]["Answers"][a_attribs["Id"]] = trim_attribs(a_attribs, "answer")
-                        self.questions[a_attribs["ParentId"]]["ParsedAnswers"] += 1
-                else:
-                    self.questions[a_attribs["ParentId"]]["ParsedAnswers"] += 1
-            else:
-                self.questions[a_attribs["ParentId"]]["ParsedAnswers"] += 1
+        # .get, since indexing the defaultdict would insert None for answers whose question isn't pending
+        parent = self.questions.get(a_attribs["ParentId"])
+        if parent is None:
+            return
+        parent["ParsedAnswers"] += 1
+        if a_attribs["Id"] is None:
+            return
+        if is_accepted_answer(a_attribs, parent) or self.is_above_threshold(a_attribs):
+            self.keep_answer(parent, trim_attribs(a_attribs, "answer"))
+
+    def keep_answer(self, parent, answer):
+        """
+        Inserts answer into the question's Answers list, which holds (-score, arrival order, answer) tuples sorted
+        best first, and drops the lowest scoring answer if there are now more than max_responses. An accepted answer
+        competes on score like any other, since only the top max_responses are ever written.
+        """
+        if answer["Body"] is None and answer["BodyParsed"] is None:
+            # never written, so it shouldn't take up one of the max_responses places
+            return
+        answers = parent["Answers"]
+        # keep at least one answer, since a question is only written if it has some answer
+        limit = max(self.max_responses, 1)
+        # ParsedAnswers has already been incremented for this answer, so it is unique within the question
+        key = (-int(answer["Score"]), parent["ParsedAnswers"])
+        if len(answers) >= limit and key > answers[-1][:2]:
+            return
+        bisect.insort(answers, key + (answer,))
+        if len(answers) > limit:
+            answers.pop()
+
+    def count_row(self):
+        self.rows_parsed += 1
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled(f"{self.name}: cancelled after {self.rows_parsed:_} rows")
+        if self.metrics is not None and self.rows_parsed % 1000 == 0 and self.metrics.due():
+            self.metrics.report(self.metrics_dict())
+
+    def metrics_dict(self):
+        """progress and memory counters reported to self.metrics"""
+        return {
+            'site': self.name,
+            'shard_number': self.shard_number,
+            'phase': self.phase,
+            'rows_parsed': self.rows_parsed,
+            'threads_emitted': self.question_count,
+            'answers_emitted': self.answer_count,
+            'pending_questions': len(self.questions),
+            'comments': len(self.comment_dict) if self.comment_dict is not None else 0,
+            'comment_bytes': self.comment_dict.nbytes if self.comment_dict is not None else 0,
+            'bytes_written': self.bytes_written,
+            'write_queue': self.writer.queue.qsize() if self.writer is not None else 0,
+            'limits': dict(self.limit_counter),
+        }
+
+    def write(self, out_name, out_str, meta=None):
+        if self.writer is not None:
+            self.writer.put(out_name, out_str, meta)
+        else:
+            self._write(out_name, out_str, meta)
 
-    def write(self, out_name, out_str):
+    def close(self):
+        """waits for all pending documents to be written, raising any error from the background writer"""
+        if self.writer is not None:
+            self.writer.close()
+        if self.slow_path_file is not None:
+            self.slow_path_file.close()
+            self.slow_path_file = None
+
+    def abort(self):
+        """
+        stops the background writer without writing its pending documents, after an error. Its thread would otherwise
+        keep this pairer, with its comments and pending questions, alive
+        """
+        if self.writer is not None:
+            self.writer.abort()
+        if self.slow_path_file is not None:
+            self.slow_path_file.close()
+            self.slow_path_file = None
+
+    def _write(self, out_name, out_str, meta=None):
+        if self.metrics is not None:
+            self.bytes_written += len(out_str.encode('utf-8', 'replace'))
         if self.out_format == "none":
             pass
         elif self.out_format == "fairseq":
@@ -210,7 +404,7 @@ class QA_Pairer():
             raw_file.write(line)
             raw_file.write("\n\n")
 
-            bpe_file.write(' '.join(str(ix) for ix in self.tokenizer.encode(line).ids))
+            bpe_file.write(' '.join(str(ix) for ix in self.pop_token_ids(out_name, out_str, line)))
             bpe_file.write("\n\n")
         elif self.out_format == "txt":
             fname = "{}/{}".format(self.out_folder, out_name)
@@ -224,6 +418,13 @@ class QA_Pairer():
                 self.ar.writestr(out_name, filter_newlines(out_str))
             except:
                 self.ar.writestr(out_name, filter_newlines(handle_unicode_errors(out_str)))
+        elif self.out_format == "shards":
+            try:
+                location = self.ar.add(out_name, filter_newlines(out_str), meta)
+            except:
+                location = self.ar.add(out_name, filter_newlines(handle_unicode_errors(out_str)), meta)
+            if self.index is not None:
+                self.index.add(location, dict(meta or {}, name=out_name))
         elif self.out_format == "lm_dataformat":
             try:
                 self.ar.add_data(filter_newlines(out_str), meta={
@@ -239,130 +440,352 @@ class QA_Pairer():
         tags = cls.tag_split_re.split(attrib["Tags"])
         return [t for t in tags if bool(t)]
 
-    def update_tag_and_token_counts(self, tags, out_str):
+    def encode(self, text):
+        """returns the token ids of text, using the token cache if there is one"""
+        if self.token_cache is not None:
+            return self.token_cache.encode(text)
+        return self.tokenizer.encode(text).ids
+
+    def update_tag_and_token_counts(self, tags, out_str, token_ids=None):
+        """
+        :param token_ids: token ids of out_str, if they have already been computed
+        :return: the token ids of out_str, if they were given or computed, else None
+        """
         self.tag_counter.update(tags)
         if self.count_tokens and self.tokenizer is not None:
-            tokens = self.tokenizer.encode(out_str).ids
-            token_count = len(tokens)
+            if token_ids is None:
+                token_ids = self.encode(out_str)
+            token_count = len(token_ids)
             for tag in tags:
                 self.token_counter[tag] += token_count
             self.token_count += token_count
+        return token_ids
+
+    def pop_token_ids(self, out_name, out_str, text):
+        """
+        token ids of text, reusing the ones computed while rendering out_str if text is the same string (i.e.
+        filter_newlines didn't change it)
+        """
+        token_ids = self.token_ids_by_name.pop(out_name, None)
+        if token_ids is None or text != out_str:
+            token_ids = self.encode(text)
+        return token_ids
 
     def print_status(self):
         print(f"{self.question_count:_} questions")
         print(f"{self.answer_count:_} answers")
-        print(f"{self.answer_count / self.question_count:.2f} answers / question")
+        if self.question_count:
+            print(f"{self.answer_count / self.question_count:.2f} answers / question")
 
         print("common tags:")
         underscore_print_counter(self.tag_counter, n=20)
         if self.tokenizer is not None:
             print(f"total tokens: {self.token_count:_}")
             underscore_print_counter(self.token_counter, n=20)
+        if self.token_cache is not None:
+            self.token_cache.print_status()
+        if self.limit_counter:
+            print("posts over limits:")
+            underscore_print_counter(self.limit_counter)
         print()
 
+    def stats_dict(self):
+        """counts for this site / shard, which sharding.merge_stats can combine across shards"""
+        return {
+            'name': self.name,
+            'shard_number': self.shard_number,
+            'num_shards': self.shard_plan.num_shards if self.shard_plan is not None else self.num_shards,
+            'question_count': self.question_count,
+            'answer_count': self.answer_count,
+            'char_count': self.char_count,
+            'token_count': self.token_count,
+            'tag_counter': dict(self.tag_counter),
+            'token_counter': dict(self.token_counter),
+            'limit_counter': dict(self.limit_counter),
+        }
+
+    def write_stats(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats_dict(), f)
+
     def check_complete(self, a_attribs):
         """
         checks if the parent question of the previously added answer has no future answers, and if so,
-        removes from dict and prints to file.
+        removes it from the dict and returns its rendered (out_name, out_str, meta), otherwise returns None.
         """
         keys_to_del = []
-        parent = self.questions[a_attribs["ParentId"]]
+        thread = None
+        parent = self.questions.get(a_attribs["ParentId"])
         if a_attribs is not None and parent is not None:
             if parent["AnswerCount"] is not None and parent["ParsedAnswers"] is not None:
                 if int(parent["ParsedAnswers"]) == int(parent['AnswerCount']):
                     keys_to_del.append(a_attribs["ParentId"])
                     if parent["Answers"] is not None and len(parent["Answers"]) > 0:
-                        out_name = "{}_{}.txt".format(self.name, parent["Id"].zfill(10))
-                        out_strs = []
-
-                        question_body = ""
-
-                        question_attrs = {}
-                        tags = self.get_tags(parent)
-                        random.shuffle(tags)
-                        tag_str = ','.join(tags)
-                        if tag_str:
-                            question_attrs['tags'] = tag_str
-                        
-                        if (self.name, 'questions') in self.threshold_lower_bounds:
-                            question_votes = int(parent['Score'])
-                            question_attrs['dscore'] = threshold(self.threshold_lower_bounds[(self.name, 'questions')], question_votes)
-
-                        if parent["TitleParsed"] is not None:
-                            title_parsed = parent["TitleParsed"]
-                            question_body += title_parsed
-                        elif parent["Title"] is not None:
-                            title_parsed = BeautifulSoup(parent["Title"], "html.parser").get_text()
-                            question_body += title_parsed
-
-                        if parent["BodyParsed"] is not None:
-                            body_parsed = parent["BodyParsed"]
-                            if question_body:
-                                question_body += '\n\n{}'.format(body_parsed)
-                            else:
-                                question_body = body_parsed
-                        elif parent["Body"] is not None:
-                            body_parsed = CodePreservingBeautifulSoup(parent["Body"], "html.parser").get_text()
-                            if question_body:
-                                question_body += '\n\n{}'.format(body_parsed)
-                            else:
-                                question_body = body_parsed
-                        
-                        question_body = self.remove_username_re.sub("", question_body)
-                        out_strs.append(make_tagged("q", question_body.strip(), question_attrs, attribute_move_probability=self.attribute_move_probability))
-
-                        def add_comments(post_id):
-                            if self.comment_dict is not None:
-                                comments = self.comment_dict[post_id][:self.max_comments]
-                                comment_str = '\n'.join(make_tagged('c', comment.strip(), {}) for comment in comments)
-                                if comment_str:
-                                    out_strs.append(comment_str)
-                        
-                        add_comments(parent["Id"])
-
-                        if parent["Answers"] is not None:
-                            answers = sorted(parent["Answers"].items(), key=lambda t: int(t[1]["Score"]), reverse=True)
-                            count = 0
-                            for key, answer in answers:
-                                if count >= self.max_responses:
-                                    break
-                                if answer["BodyParsed"] is not None:
-                                    answer_body_parsed = answer["BodyParsed"]
-                                elif answer["Body"] is not None:
-                                    answer_body_parsed = CodePreservingBeautifulSoup(answer["Body"], "html.parser").get_text()
-                                else:
-                                    continue
-
-                                answer_body_parsed = self.remove_username_re.sub("", answer_body_parsed)
-
-                                answer_attrs = {}
-                                
-                                if (self.name, 'answers') in self.threshold_lower_bounds:
-                                    answer_votes = int(answer['Score'])
-                                    answer_attrs['dscore'] = threshold(self.threshold_lower_bounds[(self.name, 'answers')], answer_votes)
-
-                                if tag_str:
-                                    answer_attrs['tags'] = tag_str
-
-                                out_strs.append(make_tagged("a", answer_body_parsed.strip(), answer_attrs, attribute_move_probability=self.attribute_move_probability))
-
-                                add_comments(answer["Id"])
-                                
-                                count += 1
-                                self.answer_count += 1
-                        
-                        out_str = '\n'.join(out_strs)
-
-                        self.question_count += 1
-                        tags = self.get_tags(parent)
-                        self.update_tag_and_token_counts(tags, out_str)
-                        self.write(out_name, out_str)
-
-                        if self.question_count % 100_000 == 0:
-                            self.print_status()
+                        thread = self.render_thread(parent)
 
         for key in keys_to_del:
             self.questions.pop(key, None)
+        return thread
+
+    def render_thread(self, parent, enforce_limits=True):
+        """
+        renders a completed question and its kept answers, and updates the counters.
+
+        :param enforce_limits: apply the max_body_size / max_parse_seconds / max_tokens limits
+        :return: (out_name, out_str, meta), or None if the thread was skipped or deferred because of a limit
+        """
+        token_ids = None
+        try:
+            out_name, parts, meta = self.render_parts(parent, enforce_limits)
+            if enforce_limits and self.max_tokens is not None:
+                parts, token_ids = self.apply_token_limit(parent["Id"], parts)
+        except PostLimitExceeded as e:
+            if e.policy == "defer":
+                self.defer_thread(parent, e)
+            return None
+
+        out_str = '\n'.join(part for _, part in parts)
+
+        self.question_count += 1
+        self.answer_count += sum(1 for kind, _ in parts if kind == "a")
+        self.char_count += len(out_str)
+        token_ids = self.update_tag_and_token_counts(meta['tags'], out_str, token_ids)
+        if token_ids is not None and self.reuse_token_ids:
+            self.token_ids_by_name[out_name] = token_ids
+
+        if self.question_count % 100_000 == 0:
+            self.print_status()
+        return out_name, out_str, meta
+
+    def render_parts(self, parent, enforce_limits=True):
+        """
+        :return: (out_name, parts, meta), where parts is a list of (kind, str) with kind one of "q", "c" or "a", which
+            joined by newlines make up the document
+        """
+        out_name = "{}_{}.txt".format(self.name, parent["Id"].zfill(10))
+        out_strs = []
+
+        question_body = ""
+
+        question_attrs = {}
+        rng = make_rng(self.name, parent["Id"], seed=self.seed)
+        tags = self.get_tags(parent)
+        rng.shuffle(tags)
+        tag_str = ','.join(tags)
+        if tag_str:
+            question_attrs['tags'] = tag_str
+
+        if (self.name, 'questions') in self.threshold_lower_bounds:
+            question_votes = int(parent['Score'])
+            question_attrs['dscore'] = threshold(self.threshold_lower_bounds[(self.name, 'questions')], question_votes)
+
+        if parent["TitleParsed"] is not None:
+            title_parsed = parent["TitleParsed"]
+            question_body += title_parsed
+        elif parent["Title"] is not None:
+            title_parsed = self.parse_html(parent["Title"], parent["Id"], BeautifulSoup, enforce_limits)
+            question_body += title_parsed
+
+        if parent["BodyParsed"] is not None:
+            body_parsed = self.limit_size(parent["BodyParsed"], parent["Id"], enforce_limits)
+            if question_body:
+                question_body += '\n\n{}'.format(body_parsed)
+            else:
+                question_body = body_parsed
+        elif parent["Body"] is not None:
+            body_parsed = self.parse_html(parent["Body"], parent["Id"], CodePreservingBeautifulSoup, enforce_limits)
+            if question_body:
+                question_body += '\n\n{}'.format(body_parsed)
+            else:
+                question_body = body_parsed
+
+        question_body = self.remove_username_re.sub("", question_body)
+        out_strs.append(("q", make_tagged("q", question_body.strip(), question_attrs, attribute_move_probability=self.attribute_move_probability, rng=rng)))
+
+        def add_comments(post_id):
+            if self.comment_dict is not None:
+                comments = self.comment_dict.get(post_id, limit=self.max_comments)
+                comment_str = '\n'.join(make_tagged('c', comment.strip(), {}) for comment in comments)
+                if comment_str:
+                    out_strs.append(("c", comment_str))
+
+        add_comments(parent["Id"])
+
+        if parent["Answers"] is not None:
+            # already sorted by descending score
+            count = 0
+            for _, _, answer in parent["Answers"]:
+                if count >= self.max_responses:
+                    break
+                try:
+                    if answer["BodyParsed"] is not None:
+                        answer_body_parsed = self.limit_size(answer["BodyParsed"], answer["Id"], enforce_limits)
+                    elif answer["Body"] is not None:
+                        answer_body_parsed = self.parse_html(answer["Body"], answer["Id"], CodePreservingBeautifulSoup, enforce_limits)
+                    else:
+                        continue
+                except PostLimitExceeded as e:
+                    # a skipped answer leaves its place to the next best answer; deferral applies to the whole thread
+                    if e.policy == "skip":
+                        continue
+                    raise
+
+                answer_body_parsed = self.remove_username_re.sub("", answer_body_parsed)
+
+                answer_attrs = {}
+
+                if (self.name, 'answers') in self.threshold_lower_bounds:
+                    answer_votes = int(answer['Score'])
+                    answer_attrs['dscore'] = threshold(self.threshold_lower_bounds[(self.name, 'answers')], answer_votes)
+
+                if tag_str:
+                    answer_attrs['tags'] = tag_str
+
+                out_strs.append(("a", make_tagged("a", answer_body_parsed.strip(), answer_attrs, attribute_move_probability=self.attribute_move_probability, rng=rng)))
+
+                add_comments(answer["Id"])
+
+                count += 1
+
+        meta = {
+            'site': self.name,
+            'id': int(parent["Id"]),
+            'tags': self.get_tags(parent),
+            'score': int(parent["Score"]) if parent["Score"] is not None else None,
+            'dscore': question_attrs.get('dscore'),
+        }
+        return out_name, out_strs, meta
+
+    def limit_exceeded(self, limit, post_id, detail, policy=None):
+        """
+        records that a post exceeded a limit, and raises PostLimitExceeded unless the policy is to truncate
+
+        :param policy: overrides oversize_policy, for posts that can't be truncated
+        """
+        policy = policy or self.oversize_policy
+        action = {"truncate": "truncated", "skip": "skipped", "defer": "deferred"}[policy]
+        self.limit_counter[f"{limit}_{action}"] += 1
+        print(f"{self.name}: post {post_id} exceeds the {limit} limit ({detail}), {action}")
+        if policy != "truncate":
+            raise PostLimitExceeded(limit, post_id, detail, policy)
+
+    def limit_size(self, text, post_id, enforce_limits=True):
+        if enforce_limits and self.max_body_size is not None and len(text) > self.max_body_size:
+            self.limit_exceeded("body_size", post_id, f"{len(text):_} characters")
+            text = text[:self.max_body_size]
+        return text
+
+    def parse_html(self, html, post_id, soup_cls=None, enforce_limits=True):
+        """
+        returns the text of html, applying the body size and parse time limits. When truncating, a body that takes
+        longer than max_parse_seconds to parse falls back to stripping its tags with a regex
+
+        :param soup_cls: BeautifulSoup class to parse with (default: CodePreservingBeautifulSoup)
+        """
+        soup_cls = soup_cls or CodePreservingBeautifulSoup
+        html = self.limit_size(html, post_id, enforce_limits)
+        if not enforce_limits or self.max_parse_seconds is None:
+            return soup_cls(html, "html.parser").get_text()
+        start = time.time()
+        try:
+            with time_limit(self.max_parse_seconds):
+                text = soup_cls(html, "html.parser").get_text()
+        except ParseTimeout:
+            text = None
+        elapsed = time.time() - start
+        # time_limit can only interrupt the parse on the main thread; elsewhere the budget is checked afterwards
+        if text is None or elapsed > self.max_parse_seconds:
+            self.limit_exceeded("parse_time", post_id, f"{elapsed:.3g}s")
+            if text is None:
+                text = strip_html(html)
+        return text
+
+    def apply_token_limit(self, question_id, parts):
+        """
+        if the document is longer than max_tokens, truncates it to the longest prefix of whole parts (question,
+        comments, answers) that fits
+
+        :return: (parts, token ids of the document if it wasn't truncated, else None)
+        """
+        token_ids = self.encode('\n'.join(part for _, part in parts))
+        token_count = len(token_ids)
+        if token_count <= self.max_tokens:
+            return parts, token_ids
+        detail = f"{token_count:_} tokens"
+        if self.oversize_policy != "truncate":
+            self.limit_exceeded("tokens", question_id, detail)
+        kept = []
+        total = 0
+        for kind, part in parts:
+            # +1 for the joining newline
+            total += len(self.encode(part)) + 1
+            if total > self.max_tokens:
+                break
+            kept.append((kind, part))
+        if not any(kind == "a" for kind, _ in kept):
+            # not even the question and one answer fit
+            self.limit_exceeded("tokens", question_id, detail, policy="skip")
+        self.limit_exceeded("tokens", question_id, detail)
+        # the truncated document's ids aren't necessarily the concatenation of its parts', so they're not reused
+        return kept, None
+
+    def defer_thread(self, parent, exceeded):
+        """
+        writes the raw question and kept answers to the slow path file, to be rendered later without limits by
+        main_deferred
+        """
+        if self.slow_path is None:
+            return
+        if self.slow_path_file is None:
+            os.makedirs(os.path.dirname(self.slow_path) or '.', exist_ok=True)
+            self.slow_path_file = open(self.slow_path, 'a')
+        question = {k: v for k, v in parent.items() if k != "Answers"}
+        answers = [answer for _, _, answer in parent["Answers"]]
+        self.slow_path_file.write(json.dumps({
+            'site': self.name, 'limit': exceeded.limit, 'detail': exceeded.detail,
+            'question': question, 'answers': answers,
+        }) + "\n")
+
+    def iter_deferred_threads(self, slow_path):
+        """renders the threads written to a slow path file by defer_thread, without limits"""
+        with open(slow_path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                parent = Record(entry['question'])
+                parent["Answers"] = [(-int(answer["Score"]), i, Record(answer)) for i, answer in enumerate(entry['answers'])]
+                thread = self.render_thread(parent, enforce_limits=False)
+                if thread is not None:
+                    yield thread
+
+    def main_deferred(self, slow_path):
+        """like main, but for the threads in a slow path file"""
+        os.makedirs(self.out_folder, exist_ok=True)
+        self.phase = "deferred"
+        try:
+            for out_name, out_str, meta in self.iter_deferred_threads(slow_path):
+                self.write(out_name, out_str, meta)
+        except BaseException:
+            self.abort()
+            raise
+        self.close()
+        self.finish()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class PostLimitExceeded(Exception):
+
+    def __init__(self, limit, post_id, detail, policy):
+        super().__init__(f"post {post_id} exceeds the {limit} limit ({detail})")
+        self.limit = limit
+        self.post_id = post_id
+        self.detail = detail
+        # "skip" or "defer"
+        self.policy = policy
 
 
 class CodePreservingBeautifulSoup(BeautifulSoup):
@@ -0,0 +1,53 @@
+import traceback
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+def run_pipeline(items, stages, max_in_flight=None):
+    """
+    Passes every item through a sequence of stages, each running in its own executor, so that different items can be
+    in different stages at the same time: e.g. site N+1 is downloading and extracting while site N is being parsed.
+
+    Each stage's concurrency is limited by the max_workers of its executor. max_in_flight additionally limits how many
+    items can have started the first stage without having finished the last one, which bounds the disk space taken up
+    by downloaded but unprocessed dumps. Items are started in order.
+
+    If a stage raises, the traceback is printed and the item is dropped from the remaining stages.
+
+    :param items: items to process, e.g. site names
+    :param stages: list of (stage name, function, executor). Each function is called with the item and its return
+        value is ignored. For a ProcessPoolExecutor, the function must be picklable
+    :param max_in_flight: maximum number of items in the pipeline at once (default: unlimited)
+    :return: list of (item, stage name) for items that failed
+    """
+    pending_items = list(items)
+    pending_items.reverse()
+    # future -> (item, index of the stage it is running)
+    running = {}
+    failures = []
+
+    def submit(item, stage_index):
+        stage_name, fn, executor = stages[stage_index]
+        running[executor.submit(fn, item)] = (item, stage_index)
+
+    def fill():
+        while pending_items and (max_in_flight is None or len(running) < max_in_flight):
+            submit(pending_items.pop(), 0)
+
+    fill()
+    while running:
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            item, stage_index = running.pop(future)
+            stage_name = stages[stage_index][0]
+            try:
+                future.result()
+            except Exception:
+                print(f"{stage_name} failed for {item}:")
+                traceback.print_exc()
+                failures.append((item, stage_name))
+                continue
+            print(f"{stage_name} finished for {item}")
+            if stage_index + 1 < len(stages):
+                submit(item, stage_index + 1)
+        fill()
+    return failures
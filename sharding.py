@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import bisect
+from collections import Counter
+
+from tqdm import tqdm
+
+from utils import *
+from csv_reader import POST_COLUMNS
+
+# rough stand-in for BPE tokens: words and individual punctuation characters
+approximate_token_re = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_size(text, estimate="bytes"):
+    if text is None:
+        return 0
+    if estimate == "bytes":
+        return len(text.encode('utf-8', 'replace'))
+    elif estimate == "tokens":
+        return sum(1 for _ in approximate_token_re.finditer(text))
+    else:
+        raise ValueError(f"unrecognized estimate {estimate}")
+
+
+def estimate_question_weights(post_path, in_format="xml", estimate="bytes"):
+    """
+    Estimates the output size of each thread from the raw post sizes: the question's title and body plus the bodies of
+    all of its answers. Questions without answers, which produce no output, are left out.
+
+    :return: Dict[question id: int, estimated size]
+    """
+    weights = {}
+    for record in tqdm(iter_records(post_path, in_format, POST_COLUMNS), desc="Estimating thread sizes", ncols=120):
+        if is_question(record):
+            if has_answers(record):
+                weights[int(record["Id"])] = estimate_size(record["Title"], estimate) + estimate_size(record["Body"], estimate)
+        elif is_answer(record) and record["ParentId"] is not None:
+            parent_id = int(record["ParentId"])
+            if parent_id in weights:
+                weights[parent_id] += estimate_size(record["Body"], estimate)
+    return weights
+
+
+class ShardPlan():
+
+    def __init__(self, boundaries, shard_weights=None, estimate=None):
+        """
+        Splits question ids into contiguous ranges: shard i holds the ids in [boundaries[i-1], boundaries[i]), with the
+        first shard starting at the lowest id and the last ending at the highest.
+
+        :param boundaries: the first question id of each shard after the first
+        :param shard_weights: the estimated output size of each shard, for reporting
+        :param estimate: what the weights measure ("bytes" or "tokens")
+        """
+        self.boundaries = list(boundaries)
+        self.num_shards = len(self.boundaries) + 1
+        self.shard_weights = shard_weights
+        self.estimate = estimate
+
+    @classmethod
+    def from_weights(cls, weights, num_shards, estimate=None):
+        """
+        Builds a plan whose shards have roughly equal total weight, by cutting the id-ordered threads wherever the
+        cumulative weight passes a multiple of total / num_shards.
+
+        :param weights: Dict[question id, estimated size], as returned by estimate_question_weights
+        """
+        question_ids = sorted(weights)
+        total = sum(weights.values())
+        boundaries = []
+        shard_weights = [0] * num_shards
+        cumulative = 0
+        for question_id in question_ids:
+            # start a new shard once this one has its share of the total
+            while len(boundaries) < num_shards - 1 and cumulative >= total * (len(boundaries) + 1) / num_shards:
+                boundaries.append(question_id)
+            shard_weights[len(boundaries)] += weights[question_id]
+            cumulative += weights[question_id]
+        # if there are fewer threads than shards, the remaining shards are empty
+        while len(boundaries) < num_shards - 1:
+            boundaries.append(question_ids[-1] + 1 if question_ids else 0)
+        return cls(boundaries, shard_weights=shard_weights, estimate=estimate)
+
+    def shard_of(self, question_id):
+        return bisect.bisect_right(self.boundaries, question_id)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'num_shards': self.num_shards,
+                'boundaries': self.boundaries,
+                'shard_weights': self.shard_weights,
+                'estimate': self.estimate,
+            }, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            d = json.load(f)
+        plan = cls(d['boundaries'], shard_weights=d.get('shard_weights'), estimate=d.get('estimate'))
+        assert plan.num_shards == d['num_shards']
+        return plan
+
+    @staticmethod
+    def plan_path(plan_folder, name):
+        return os.path.join(plan_folder, f"{name}.plan.json")
+
+
+def merge_stats(stats_list):
+    """
+    Combines the per-shard statistics written by QA_Pairer.write_stats into one report, with totals over everything and
+    per site.
+    """
+    count_keys = ['question_count', 'answer_count', 'token_count', 'char_count']
+    counter_keys = ['tag_counter', 'token_counter', 'limit_counter']
+
+    def empty():
+        d = {k: 0 for k in count_keys}
+        d.update({k: Counter() for k in counter_keys})
+        d['num_shards'] = 0
+        return d
+
+    total = empty()
+    sites = {}
+    for stats in stats_list:
+        site = sites.setdefault(stats['name'], empty())
+        for d in [total, site]:
+            for k in count_keys:
+                d[k] += stats.get(k, 0)
+            for k in counter_keys:
+                d[k].update(stats.get(k, {}))
+            d['num_shards'] += 1
+    total['sites'] = sites
+    return total
+
+
+def print_stats(stats, n=20):
+    print(f"{stats['num_shards']:_} shards")
+    print(f"{stats['question_count']:_} questions")
+    print(f"{stats['answer_count']:_} answers")
+    if stats['question_count']:
+        print(f"{stats['answer_count'] / stats['question_count']:.2f} answers / question")
+    print(f"{stats['char_count']:_} characters")
+    print("common tags:")
+    underscore_print_counter(stats['tag_counter'], n=n)
+    if stats['token_count']:
+        print(f"total tokens: {stats['token_count']:_}")
+        underscore_print_counter(stats['token_counter'], n=n)
+    if stats['limit_counter']:
+        print("posts over limits:")
+        underscore_print_counter(stats['limit_counter'])
+    print()
+
+
+if __name__ == "__main__":
+    import glob
+    import argparse
+    parser = argparse.ArgumentParser(description='plan size-balanced shards, or merge per-shard statistics')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help='write a {name}.plan.json shard plan for each site, for main.py --shard_plan_folder')
+    plan_parser.add_argument('--names', required=True, help='names of stackexchanges to plan, separated by commas')
+    plan_parser.add_argument('--num_shards', type=int, required=True)
+    plan_parser.add_argument('--estimate', choices=["bytes", "tokens"], default="bytes",
+                             help='balance shards by estimated output bytes, or by an approximate token count')
+    plan_parser.add_argument('--in_folder', default='dumps')
+    plan_parser.add_argument('--in_format', choices=["xml", "csv"], default="xml")
+    plan_parser.add_argument('--plan_folder', default='plans')
+
+    merge_parser = subparsers.add_parser('merge', help='combine statistics written by main.py --stats_folder')
+    merge_parser.add_argument('stats_files', nargs='+', help='json files, or folders containing them')
+    merge_parser.add_argument('--out', help='write the merged report to this json file')
+    merge_parser.add_argument('--per_site', action='store_true', help='also print statistics for each site')
+
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        os.makedirs(args.plan_folder, exist_ok=True)
+        for name in args.names.split(','):
+            name = name.strip().lower()
+            post_path = "{}/{}/Posts.{}".format(args.in_folder, name, args.in_format)
+            weights = estimate_question_weights(post_path, args.in_format, args.estimate)
+            plan = ShardPlan.from_weights(weights, args.num_shards, estimate=args.estimate)
+            path = ShardPlan.plan_path(args.plan_folder, name)
+            plan.save(path)
+            print(f"{name}: {len(weights):_} threads, estimated {args.estimate} per shard:")
+            print('\t' + ' | '.join(f"{w:_}" for w in plan.shard_weights))
+            print(f"wrote {path}")
+    elif args.command == 'merge':
+        paths = []
+        for path in args.stats_files:
+            if os.path.isdir(path):
+                paths.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+            else:
+                paths.append(path)
+        stats_list = []
+        for path in paths:
+            with open(path, 'r') as f:
+                stats_list.append(json.load(f))
+        merged = merge_stats(stats_list)
+        if args.per_site:
+            for name, site_stats in sorted(merged['sites'].items()):
+                print(f"{name}:")
+                print_stats(site_stats)
+        print("total:")
+        print_stats(merged)
+        if args.out is not None:
+            with open(args.out, 'w') as f:
+                json.dump(merged, f, indent=1)
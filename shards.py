@@ -0,0 +1,275 @@
+import os
+import re
+import json
+import glob
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ShardWriter():
+
+    def __init__(self, out_folder, prefix, max_shard_bytes=256 * 1024 * 1024, compress=False, compression_level=3):
+        """
+        Packs documents into size-rolled JSONL shards, each with an index of byte offsets so that any document can be
+        read back by name without scanning.
+
+        Shards are written to {out_folder}/{prefix}_{n:05d}.jsonl (or .jsonl.zst if compress), and their indexes to
+        {out_folder}/{prefix}_{n:05d}.idx, one "name<TAB>offset<TAB>length" line per document in the order they were
+        added. When a shard is closed, the same lines sorted by name are written to {prefix}_{n:05d}.sidx, which
+        ShardReader binary searches to find a document without loading any index into memory. Records have the same
+        {'text': ..., 'meta': {'name': ...}} layout as lm_dataformat. When compressing, every record is its own zstd
+        frame, so a shard is still a valid zstd stream as a whole and each record can be decompressed independently.
+
+        :param out_folder: folder to write shards and indexes to
+        :param prefix: shard file prefix, e.g. the site name
+        :param max_shard_bytes: a new shard is started once the current one reaches this many bytes
+        :param compress: compress each record with zstd (requires the zstandard package)
+        """
+        if compress and zstandard is None:
+            raise ImportError("compressed shards require the zstandard package")
+        self.out_folder = out_folder
+        self.prefix = prefix
+        self.max_shard_bytes = max_shard_bytes
+        self.compressor = zstandard.ZstdCompressor(level=compression_level) if compress else None
+        os.makedirs(out_folder, exist_ok=True)
+
+        self.shard_index = -1
+        self.shard_name = None
+        self.data_file = None
+        self.index_file = None
+        self.offset = 0
+        self.bytes_written = 0
+        self.doc_count = 0
+        # (name, offset, length) of the documents in the current shard, for its sorted index
+        self.entries = []
+
+    @staticmethod
+    def shard_filename(prefix, shard_index, compress):
+        ext = ".jsonl.zst" if compress else ".jsonl"
+        return f"{prefix}_{shard_index:05d}{ext}"
+
+    def _roll(self):
+        self._close_shard()
+        self.shard_index += 1
+        self.shard_name = self.shard_filename(self.prefix, self.shard_index, self.compressor is not None)
+        self.data_file = open(os.path.join(self.out_folder, self.shard_name), 'wb')
+        self.index_file = open(os.path.join(self.out_folder, f"{self.prefix}_{self.shard_index:05d}.idx"), 'w')
+        self.offset = 0
+
+    def _close_shard(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = None
+            self.index_file = None
+            # sorted by the utf-8 bytes of the names, which is the order ShardReader compares them in
+            self.entries.sort(key=lambda entry: entry[0].encode('utf-8'))
+            with open(os.path.join(self.out_folder, f"{self.prefix}_{self.shard_index:05d}.sidx"), 'w', encoding='utf-8') as f:
+                for name, offset, length in self.entries:
+                    f.write(f"{name}\t{offset}\t{length}\n")
+            self.entries = []
+
+    def add(self, name, text, meta=None):
+        """
+        Appends a document to the current shard, starting a new shard first if the current one is full.
+
+        :return: (shard file name, byte offset, byte length) of the stored record
+        """
+        assert '\t' not in name and '\n' not in name, "document names can't contain tabs or newlines"
+        if self.data_file is None or self.offset >= self.max_shard_bytes:
+            self._roll()
+        record_meta = {'name': name}
+        if meta:
+            record_meta.update(meta)
+        data = json.dumps({'text': text, 'meta': record_meta}).encode('UTF-8') + b'\n'
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        offset = self.offset
+        self.data_file.write(data)
+        self.index_file.write(f"{name}\t{offset}\t{len(data)}\n")
+        self.entries.append((name, offset, len(data)))
+        self.offset += len(data)
+        self.bytes_written += len(data)
+        self.doc_count += 1
+        return self.shard_name, offset, len(data)
+
+    def close(self):
+        self._close_shard()
+
+
+class ShardReader():
+
+    shard_re = re.compile(r"^(?P<stem>.+_\d{5})\.jsonl(?P<zst>\.zst)?$")
+
+    def __init__(self, folder, prefix=None):
+        """
+        Reads documents written by ShardWriter, either all of them in shard order or single documents by name.
+
+        :param folder: folder containing the shards and their .idx files
+        :param prefix: only read shards with this prefix (default: all shards in the folder)
+        """
+        self.folder = folder
+        pattern = f"{glob.escape(prefix)}_*.jsonl*" if prefix is not None else "*.jsonl*"
+        self.shards = []
+        for path in sorted(glob.glob(os.path.join(folder, pattern))):
+            match = self.shard_re.match(os.path.basename(path))
+            if match is not None:
+                self.shards.append(os.path.basename(path))
+        # shard file name -> (first name, last name) in its sorted index, to skip shards that can't hold a name
+        self._name_ranges = {}
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+    @staticmethod
+    def index_filename(shard_name):
+        return ShardReader.shard_re.match(shard_name).group('stem') + ".idx"
+
+    @staticmethod
+    def sorted_index_filename(shard_name):
+        return ShardReader.shard_re.match(shard_name).group('stem') + ".sidx"
+
+    def iter_index(self, shard_name):
+        """yields (name, offset, length) for each record in a shard"""
+        with open(os.path.join(self.folder, self.index_filename(shard_name)), 'r') as f:
+            for line in f:
+                name, offset, length = line.rstrip('\n').split('\t')
+                yield name, int(offset), int(length)
+
+    def _name_range(self, path):
+        if path not in self._name_ranges:
+            with open(path, 'rb') as f:
+                first = f.readline().split(b'\t', 1)[0]
+                # read back from the end until the chunk holds the whole last line
+                size = f.seek(0, os.SEEK_END)
+                chunk_size = 4096
+                while True:
+                    f.seek(max(size - chunk_size, 0))
+                    lines = f.read().splitlines()
+                    if len(lines) > 1 or chunk_size >= size:
+                        break
+                    chunk_size *= 2
+                last = lines[-1].split(b'\t', 1)[0] if lines else b''
+            self._name_ranges[path] = (first, last)
+        return self._name_ranges[path]
+
+    @staticmethod
+    def search_sorted_index(path, key):
+        """
+        binary searches a .sidx file for the line of the name key (utf-8 bytes)
+
+        :return: (offset, length), or None if the name isn't in the index
+        """
+        with open(path, 'rb') as f:
+            # lo is always the start of a line whose name is < key (or 0), and the line of key, if any, starts at or
+            # before hi
+            lo, hi = 0, f.seek(0, os.SEEK_END)
+            while hi - lo > 4096:
+                mid = (lo + hi) // 2
+                f.seek(mid)
+                f.readline()
+                pos = f.tell()
+                if pos >= hi:
+                    break
+                if f.readline().split(b'\t', 1)[0] < key:
+                    lo = pos
+                else:
+                    hi = pos
+            f.seek(lo)
+            for line in f:
+                name, offset, length = line.rstrip(b'\n').split(b'\t')
+                if name == key:
+                    return int(offset), int(length)
+                if name > key:
+                    return None
+        return None
+
+    def locate(self, name):
+        """
+        :return: (shard file name, offset, length) of the document, or None if no shard has it
+        """
+        key = name.encode('utf-8')
+        for shard_name in self.shards:
+            sorted_path = os.path.join(self.folder, self.sorted_index_filename(shard_name))
+            if os.path.exists(sorted_path):
+                first, last = self._name_range(sorted_path)
+                if not first <= key <= last:
+                    continue
+                location = self.search_sorted_index(sorted_path, key)
+                if location is not None:
+                    return (shard_name,) + location
+            else:
+                # a shard still being written, or written before sorted indexes were added
+                for other, offset, length in self.iter_index(shard_name):
+                    if other == name:
+                        return shard_name, offset, length
+        return None
+
+    def _decode(self, shard_name, data):
+        if shard_name.endswith(".zst"):
+            assert self._decompressor is not None, "reading compressed shards requires the zstandard package"
+            data = self._decompressor.decompress(data)
+        return json.loads(data)
+
+    def read_at(self, shard_name, offset, length):
+        with open(os.path.join(self.folder, shard_name), 'rb') as f:
+            f.seek(offset)
+            return self._decode(shard_name, f.read(length))
+
+    def iter_locations(self, locations):
+        """
+        Reads the records at the given (shard file name, offset, length) locations, keeping each shard open while
+        consecutive locations point into it.
+        """
+        f, open_shard = None, None
+        try:
+            for shard_name, offset, length in locations:
+                if shard_name != open_shard:
+                    if f is not None:
+                        f.close()
+                    f, open_shard = open(os.path.join(self.folder, shard_name), 'rb'), shard_name
+                f.seek(offset)
+                yield self._decode(shard_name, f.read(length))
+        finally:
+            if f is not None:
+                f.close()
+
+    def __contains__(self, name):
+        return self.locate(name) is not None
+
+    def __getitem__(self, name):
+        location = self.locate(name)
+        if location is None:
+            raise KeyError(name)
+        return self.read_at(*location)
+
+    def __len__(self):
+        count = 0
+        for shard_name in self.shards:
+            with open(os.path.join(self.folder, self.index_filename(shard_name)), 'rb') as f:
+                count += sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+        return count
+
+    def __iter__(self):
+        for shard_name in self.shards:
+            yield from self.iter_locations((shard_name, offset, length) for _, offset, length in self.iter_index(shard_name))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='print documents stored in ShardWriter output')
+    parser.add_argument('folder')
+    parser.add_argument('names', nargs='*', help='names of the documents to print. If none are given, prints every document')
+    parser.add_argument('--prefix')
+    parser.add_argument('--jsonl', action='store_true', help='print whole records as JSON lines instead of document text')
+    args = parser.parse_args()
+
+    reader = ShardReader(args.folder, prefix=args.prefix)
+    records = (reader[name] for name in args.names) if args.names else iter(reader)
+    for record in records:
+        if args.jsonl:
+            print(json.dumps(record))
+        else:
+            print(record['text'])
+            print()
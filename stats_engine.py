@@ -0,0 +1,319 @@
+import os
+import json
+from collections import Counter, defaultdict
+
+import numpy as np
+from tqdm import tqdm
+from bs4 import BeautifulSoup
+
+from utils import *
+
+import warnings
+warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
+
+DEFAULT_QUANTILES = [0, 0.2, 0.4, 0.5, 0.6, 0.8, 1.0]
+
+
+def zeno(num_vals):
+    """quantiles 0, 1/2, 3/4, 7/8, ..., for looking at the long tail of scores"""
+    last = 0
+    vals = [last]
+    while len(vals) < num_vals:
+        last = 1 - ((1 - last) / 2)
+        vals.append(last)
+    return np.array(vals)
+
+
+def histogram_quantiles(histogram, quantiles):
+    """
+    Quantiles of the values counted in histogram (Dict[value, count]), with the same linear interpolation as
+    np.quantile on the expanded values.
+    """
+    if not histogram:
+        return [None for _ in quantiles]
+    values = np.array(sorted(histogram), dtype=np.float64)
+    counts = np.array([histogram[v] for v in sorted(histogram)], dtype=np.int64)
+    cumulative = np.cumsum(counts)
+    positions = np.array(quantiles) * (cumulative[-1] - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    lower_values = values[np.searchsorted(cumulative, lower, side='right')]
+    upper_values = values[np.searchsorted(cumulative, upper, side='right')]
+    return (lower_values + (upper_values - lower_values) * (positions - lower)).tolist()
+
+
+class Row():
+
+    def __init__(self, record, text_field, parse_html, is_post=True):
+        """
+        A row of a Posts or Comments file, parsing its HTML at most once however many accumulators use it.
+
+        :param is_post: whether the row is from a Posts file, rather than a Comments file
+        """
+        self.record = record
+        self.is_post = is_post
+        self.raw_text = record[text_field]
+        self.parse_html = parse_html
+        self._soup = None
+
+    @property
+    def soup(self):
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.raw_text, "html.parser")
+        return self._soup
+
+    @property
+    def text(self):
+        if self.parse_html:
+            return self.soup.get_text()
+        return self.raw_text
+
+    @property
+    def kind(self):
+        if not self.is_post:
+            return "comment"
+        if is_question(self.record):
+            return "question"
+        elif is_answer(self.record):
+            return "answer"
+        # tag wikis, tag wiki excerpts, moderator nominations, ...
+        return "other"
+
+
+class Accumulator():
+    """
+    Collects one kind of statistic over the rows of a file. Subclasses set name, and implement add(), result() and
+    print_result(); results must be JSON serializable so that reports can be printed without rescanning the file.
+    """
+    name = None
+
+    def add(self, row):
+        raise NotImplementedError()
+
+    def result(self):
+        raise NotImplementedError()
+
+    @staticmethod
+    def print_result(result):
+        raise NotImplementedError()
+
+
+class TextSizeAccumulator(Accumulator):
+    name = "text_size"
+
+    def __init__(self):
+        self.entries = Counter()
+        self.text_size = Counter()
+
+    def add(self, row):
+        self.entries[row.kind] += 1
+        self.text_size[row.kind] += len(row.text)
+
+    def result(self):
+        return {'entries': dict(self.entries), 'text_size': dict(self.text_size)}
+
+    @staticmethod
+    def print_result(result):
+        for kind, entries in result['entries'].items():
+            size = result['text_size'][kind]
+            print(f"\t{kind}:\t{entries:_} entries\t{size:_} characters\t{size / entries:.2f} characters / entry")
+
+
+class TokenAccumulator(Accumulator):
+    name = "tokens"
+
+    def __init__(self, tokenizer):
+        """:param tokenizer: a transformers tokenizer, called on each row's text"""
+        self.tokenizer = tokenizer
+        self.entries = Counter()
+        self.tokens = Counter()
+
+    def add(self, row):
+        self.entries[row.kind] += 1
+        self.tokens[row.kind] += len(self.tokenizer(row.text)['input_ids'])
+
+    def result(self):
+        return {'entries': dict(self.entries), 'tokens': dict(self.tokens)}
+
+    @staticmethod
+    def print_result(result):
+        for kind, entries in result['entries'].items():
+            tokens = result['tokens'][kind]
+            print(f"\t{kind}:\t{tokens:_} tokens\t{tokens / entries:.2f} tokens / entry")
+
+
+class HtmlTagAccumulator(Accumulator):
+    name = "html_tags"
+
+    def __init__(self):
+        self.tag_counter = Counter()
+        self.total_size_per_tag = Counter()
+        # Dict[tag, Dict[text size, count]], which gives exact size quantiles in far less memory than a list of sizes
+        self.size_histograms = defaultdict(Counter)
+
+    def add(self, row):
+        if not row.parse_html:
+            return
+        for tag in row.soup.find_all():
+            tag_size = len(tag.get_text())
+            self.tag_counter[tag.name] += 1
+            self.total_size_per_tag[tag.name] += tag_size
+            self.size_histograms[tag.name][tag_size] += 1
+
+    def result(self):
+        return {
+            'tag_counter': dict(self.tag_counter),
+            'total_size_per_tag': dict(self.total_size_per_tag),
+            # json keys must be strings
+            'size_histograms': {tag: {str(size): count for size, count in hist.items()}
+                                for tag, hist in self.size_histograms.items()},
+        }
+
+    @staticmethod
+    def print_result(result, limit=20, quantiles=DEFAULT_QUANTILES):
+        tag_counter = Counter(result['tag_counter'])
+        if not tag_counter:
+            print("\tno html tags")
+            return
+        print("\ttop tag counts:")
+        underscore_print_counter(tag_counter, n=limit, prefix="\t\t")
+        print("\ttotal text size per tag:")
+        underscore_print_counter(Counter(result['total_size_per_tag']), n=limit, prefix="\t\t")
+        print(f"\tsize per tag quantiles{quantiles}:")
+        for tag, _ in tag_counter.most_common(limit):
+            hist = {int(size): count for size, count in result['size_histograms'][tag].items()}
+            print(f"\t\t{tag}:\t{' | '.join(f'{int(q):_}' for q in histogram_quantiles(hist, quantiles))}")
+
+
+class ScoreAccumulator(Accumulator):
+    name = "scores"
+
+    def __init__(self):
+        # Dict[kind, Dict[score, count]]
+        self.histograms = defaultdict(Counter)
+
+    def add(self, row):
+        score = row.record["Score"]
+        if score is not None:
+            self.histograms[row.kind][int(score)] += 1
+
+    def result(self):
+        return {kind: {str(score): count for score, count in hist.items()} for kind, hist in self.histograms.items()}
+
+    @staticmethod
+    def print_result(result, buckets=6, log_spacing=False, min_score=0):
+        """prints score quantiles for each kind of row"""
+        if log_spacing:
+            qs = zeno(buckets)
+        else:
+            qs = np.arange(buckets + 1) / buckets
+        for kind, hist in result.items():
+            hist = {int(score): count for score, count in hist.items() if int(score) >= min_score}
+            print(f"\t{kind}:")
+            for q, v in zip(qs, histogram_quantiles(hist, qs)):
+                print(f"\t\t{q:0.3f}: {v}")
+
+
+ACCUMULATORS = {cls.name: cls for cls in [TextSizeAccumulator, TokenAccumulator, HtmlTagAccumulator, ScoreAccumulator]}
+
+
+class ProgressFile():
+    """file wrapper that advances a tqdm bar by the number of bytes read"""
+
+    def __init__(self, f, progress):
+        self.f = f
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.progress.update(len(data))
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def compute_stats(filename, accumulators, in_format="xml", subsample=None):
+    """
+    Runs every accumulator over the rows of a Posts or Comments file in a single pass.
+
+    :param accumulators: list of Accumulators
+    :param subsample: if given, skip every subsample-th row
+    :return: Dict[accumulator name, result]
+    """
+    basename = os.path.basename(filename)
+    if basename.startswith('Comments'):
+        text_field = 'Text'
+        parse_html = False
+        is_post = False
+    elif basename.startswith('Posts'):
+        text_field = 'Body'
+        parse_html = True
+        is_post = True
+    else:
+        raise ValueError("should be {Comments,Posts}.{xml,csv}")
+    if in_format == "csv":
+        # xml_to_csv.py has already converted the html
+        text_field = f"{text_field}Parsed" if parse_html else text_field
+        parse_html = False
+
+    num_entries = 0
+    no_text_count = 0
+    with open(filename, 'rb') as f, \
+            tqdm(total=os.path.getsize(filename), unit='B', unit_scale=True, ncols=100, desc=basename) as progress:
+        records = iter_records(ProgressFile(f, progress), in_format)
+        for record in records:
+            num_entries += 1
+            if subsample is not None and num_entries % subsample == 0:
+                continue
+            if record[text_field] is None:
+                no_text_count += 1
+                continue
+            row = Row(record, text_field, parse_html, is_post)
+            for accumulator in accumulators:
+                accumulator.add(row)
+    results = {'file': filename, 'num_entries': num_entries, 'no_text_count': no_text_count}
+    for accumulator in accumulators:
+        results[accumulator.name] = accumulator.result()
+    return results
+
+
+def print_stats(results):
+    print(f"{results['file']}: {results['num_entries']:_} entries, {results['no_text_count']:_} without text")
+    for name, cls in ACCUMULATORS.items():
+        if name in results:
+            print(f"{name}:")
+            cls.print_result(results[name])
+            print()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='compute text size, token, html tag and score statistics of a Posts or '
+                                                 'Comments file in a single pass, or print previously computed ones')
+    parser.add_argument('filename', help='Posts/Comments .xml or .csv file, or a .stats.json file to print')
+    parser.add_argument('--in_format', choices=["xml", "csv"], default="xml")
+    parser.add_argument('--accumulators', default="text_size,html_tags,scores",
+                        help=f'comma separated statistics to compute, from {",".join(ACCUMULATORS)}. tokens requires '
+                             f'the transformers package')
+    parser.add_argument('--subsample', type=int)
+    parser.add_argument('--out', help='json file to write the statistics to (default: <filename>.stats.json)')
+    args = parser.parse_args()
+
+    if args.filename.endswith('.json'):
+        with open(args.filename, 'r') as f:
+            results = json.load(f)
+    else:
+        accumulators = []
+        for name in args.accumulators.split(','):
+            if name == "tokens":
+                from transformers import GPT2TokenizerFast
+                accumulators.append(TokenAccumulator(GPT2TokenizerFast.from_pretrained("gpt2", add_prefix_space=False)))
+            else:
+                accumulators.append(ACCUMULATORS[name]())
+        results = compute_stats(args.filename, accumulators, in_format=args.in_format, subsample=args.subsample)
+        out = args.out or f"{args.filename}.stats.json"
+        with open(out, 'w') as f:
+            json.dump(results, f)
+        print(f"wrote {out}")
+    print_stats(results)
@@ -0,0 +1,121 @@
+import sys
+import json
+from multiprocessing.connection import Listener, Client
+
+
+def parse_address(address):
+    """'host:port' -> (host, int(port)); anything else is used as a unix socket path"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address
+
+
+def write_documents(documents, f):
+    """writes documents as JSON lines to a text file object, e.g. sys.stdout piped into another process"""
+    for document in documents:
+        f.write(json.dumps(document))
+        f.write('\n')
+    f.flush()
+
+
+def read_documents(f):
+    """yields the documents written by write_documents, e.g. from sys.stdin"""
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def check_authkey(address, authkey):
+    """
+    documents are sent pickled and unpickling can run arbitrary code, so TCP connections, which anyone who can reach the
+    port could make, must be authenticated
+    """
+    if isinstance(address, tuple) and authkey is None:
+        raise ValueError("an authkey is required for host:port addresses")
+
+
+def serve_documents(documents, address, authkey=None):
+    """
+    Waits for one client to connect to address, then sends it every document, followed by None to mark the end.
+    Sending blocks while the client is behind, so a slow consumer applies backpressure to the pairer.
+
+    :param address: 'host:port' or a unix socket path
+    :param authkey: shared secret (bytes) the client must also use. Required for host:port, see check_authkey
+    """
+    address = parse_address(address)
+    check_authkey(address, authkey)
+    with Listener(address, authkey=authkey) as listener:
+        with listener.accept() as conn:
+            for document in documents:
+                conn.send(document)
+            conn.send(None)
+
+
+def iter_remote_documents(address, authkey=None):
+    """yields the documents sent by serve_documents. Only connect to servers you trust: documents are unpickled"""
+    address = parse_address(address)
+    check_authkey(address, authkey)
+    with Client(address, authkey=authkey) as conn:
+        while True:
+            document = conn.recv()
+            if document is None:
+                return
+            yield document
+
+
+if __name__ == "__main__":
+    import argparse
+    from tokenization import add_tokenizer_args, get_tokenizer, get_token_cache
+    parser = argparse.ArgumentParser(description='stream the documents of a single site as they are rendered, as JSON '
+                                                 'lines on stdout or to a client connecting to a socket')
+    parser.add_argument('name', help='name of an extracted stackexchange site')
+    parser.add_argument('--address', default='-', help='"-" to write JSON lines to stdout, otherwise host:port or a unix '
+                                                       'socket path to serve documents on (see iter_remote_documents)')
+    parser.add_argument('--authkey', help='shared secret for --address, required for host:port')
+    parser.add_argument('--in_folder', default='dumps')
+    parser.add_argument('--in_format', default="xml", choices=["xml", "csv"])
+    parser.add_argument('--min_score', type=int, default=0)
+    parser.add_argument('--max_responses', type=int, default=10)
+    parser.add_argument('--max_comments', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--token_ids', help='include the token ids of each document', action='store_true')
+    # tokenizer for --token_ids
+    add_tokenizer_args(parser)
+    args = parser.parse_args()
+
+    # progress bars and status go to stderr, so that stdout only carries documents
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+
+    from pairer import QA_Pairer
+
+    if args.address != '-' and args.authkey is None:
+        check_authkey(parse_address(args.address), None)
+    if args.token_ids:
+        tokenizer = get_tokenizer(args)
+        token_cache = get_token_cache(args, tokenizer)
+    else:
+        tokenizer = None
+        token_cache = None
+
+    name = args.name.strip().lower()
+    qa = QA_Pairer("{}/{}/Posts.{}".format(args.in_folder, name, args.in_format),
+                   name=name,
+                   out_format="none",
+                   in_format=args.in_format,
+                   comment_path="{}/{}/Comments.{}".format(args.in_folder, name, args.in_format),
+                   max_responses=args.max_responses,
+                   max_comments=args.max_comments,
+                   min_score=args.min_score,
+                   seed=args.seed,
+                   tokenizer=tokenizer,
+                   token_cache=token_cache)
+    documents = qa.iter_documents(token_ids=args.token_ids)
+    if args.address == '-':
+        write_documents(documents, stdout)
+    else:
+        authkey = args.authkey.encode('utf-8') if args.authkey is not None else None
+        serve_documents(documents, args.address, authkey=authkey)
+    if token_cache is not None:
+        token_cache.close()
@@ -0,0 +1,150 @@
+import os
+import glob
+import json
+import sqlite3
+
+from shards import ShardReader
+
+
+class TagIndex():
+
+    suffix = ".index.sqlite"
+
+    def __init__(self, path, batch_size=10_000):
+        """
+        Inverted index from tags, site and discretized score (dscore) to the shard locations of documents, built while
+        ShardWriter output is written. Question scores are also stored so that queries can filter on a score range.
+
+        The index is a SQLite file with a docs table (one row per document) and a postings table of
+        (term, doc) pairs, where terms look like "tag:python", "site:stackoverflow" or "dscore:3".
+
+        :param path: SQLite file to write. An existing index at this path is replaced
+        :param batch_size: number of documents to buffer before inserting them
+        """
+        self.path = path
+        self.batch_size = batch_size
+        if os.path.exists(path):
+            os.remove(path)
+        # documents are added from the background writer thread, after the index is created on the main thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE docs (
+                doc INTEGER PRIMARY KEY, name TEXT, site TEXT, shard TEXT, offset INTEGER, length INTEGER,
+                score INTEGER, dscore INTEGER
+            );
+            CREATE TABLE postings (term TEXT, doc INTEGER);
+        """)
+        self.doc_count = 0
+        self.docs = []
+        self.postings = []
+
+    @staticmethod
+    def terms(meta):
+        terms = [f"tag:{tag}" for tag in meta.get('tags', [])]
+        if meta.get('site') is not None:
+            terms.append(f"site:{meta['site']}")
+        if meta.get('dscore') is not None:
+            terms.append(f"dscore:{meta['dscore']}")
+        return terms
+
+    def add(self, location, meta):
+        """
+        :param location: (shard file name, offset, length), as returned by ShardWriter.add
+        :param meta: document metadata with optional 'name', 'site', 'tags', 'score' and 'dscore' keys
+        """
+        shard_name, offset, length = location
+        doc = self.doc_count
+        self.doc_count += 1
+        self.docs.append((doc, meta.get('name'), meta.get('site'), shard_name, offset, length,
+                          meta.get('score'), meta.get('dscore')))
+        self.postings.extend((term, doc) for term in self.terms(meta))
+        if len(self.docs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.conn:
+            self.conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.docs)
+            self.conn.executemany("INSERT INTO postings VALUES (?, ?)", self.postings)
+        self.docs = []
+        self.postings = []
+
+    def close(self):
+        self.flush()
+        # building the lookup indexes once at the end is much cheaper than maintaining them during inserts
+        with self.conn:
+            self.conn.execute("CREATE INDEX postings_term ON postings (term, doc)")
+            self.conn.execute("CREATE INDEX docs_score ON docs (score)")
+        self.conn.close()
+
+
+def query_index(path, tags=(), sites=(), dscores=(), min_score=None, max_score=None):
+    """
+    Returns the (shard file name, offset, length) locations of documents in a TagIndex matching all the given filters,
+    in shard order.
+
+    :param tags: documents must have every one of these tags
+    :param sites: documents must come from one of these sites
+    :param dscores: documents must have one of these dscore values
+    :param min_score: minimum question score (inclusive)
+    :param max_score: maximum question score (inclusive)
+    """
+    clauses = []
+    params = []
+    for tag in tags:
+        clauses.append("doc IN (SELECT doc FROM postings WHERE term = ?)")
+        params.append(f"tag:{tag}")
+    for prefix, values in [("site", sites), ("dscore", dscores)]:
+        if values:
+            placeholders = ', '.join('?' for _ in values)
+            clauses.append(f"doc IN (SELECT doc FROM postings WHERE term IN ({placeholders}))")
+            params.extend(f"{prefix}:{value}" for value in values)
+    if min_score is not None:
+        clauses.append("score >= ?")
+        params.append(min_score)
+    if max_score is not None:
+        clauses.append("score <= ?")
+        params.append(max_score)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(f"SELECT shard, offset, length FROM docs {where} ORDER BY shard, offset", params).fetchall()
+    finally:
+        conn.close()
+
+
+def iter_matching_documents(folder, **filters):
+    """
+    Streams the records of every document matching the filters (see query_index) from all the indexed shards in folder.
+    """
+    reader = ShardReader(folder)
+    for path in sorted(glob.glob(os.path.join(folder, f"*{TagIndex.suffix}"))):
+        yield from reader.iter_locations(query_index(path, **filters))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='print documents from shards output that match a tag / site / score query')
+    parser.add_argument('folder', help='folder containing shards and their indexes, e.g. out/shards')
+    parser.add_argument('--tags', help='comma separated tags, all of which must be present')
+    parser.add_argument('--sites', help='comma separated site names, any of which can match')
+    parser.add_argument('--dscores', help='comma separated dscore values, any of which can match')
+    parser.add_argument('--min_score', type=int)
+    parser.add_argument('--max_score', type=int)
+    parser.add_argument('--count', action='store_true', help='only print the number of matching documents')
+    parser.add_argument('--jsonl', action='store_true', help='print whole records as JSON lines instead of document text')
+    args = parser.parse_args()
+
+    split = lambda x: [v.strip() for v in x.split(',')] if x else []
+    filters = dict(tags=split(args.tags), sites=split(args.sites), dscores=[int(x) for x in split(args.dscores)],
+                   min_score=args.min_score, max_score=args.max_score)
+
+    if args.count:
+        paths = glob.glob(os.path.join(args.folder, f"*{TagIndex.suffix}"))
+        print(sum(len(query_index(path, **filters)) for path in paths))
+    else:
+        for record in iter_matching_documents(args.folder, **filters):
+            if args.jsonl:
+                print(json.dumps(record))
+            else:
+                print(record['text'])
+                print()
@@ -0,0 +1,143 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+
+def tokenizer_fingerprint(*paths, **options):
+    """hash of the contents of a tokenizer's files (e.g. vocab and merges) and its options"""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(b'\0')
+    h.update(repr(sorted(options.items())).encode('utf-8'))
+    return h.digest()
+
+
+class TokenCache():
+
+    def __init__(self, path, tokenizer, fingerprint, max_bytes=None, batch_size=10_000):
+        """
+        Persistent cache of tokenizer output, keyed by a hash of the document text and the tokenizer fingerprint, so
+        that documents that are unchanged between runs (or between dump releases) aren't encoded again.
+
+        The cache is a SQLite file that can be shared by several processes, including on other machines through a shared
+        filesystem, as long as its fcntl locks work (see work_queue.WorkQueue). New entries are buffered and inserted in
+        batches. When the cache is closed, least recently used entries are evicted until the stored token ids take up
+        at most max_bytes.
+
+        :param path: SQLite file to store the cache in
+        :param tokenizer: tokenizer with an encode(text).ids method, used on cache misses
+        :param fingerprint: bytes identifying the tokenizer, see tokenizer_fingerprint
+        :param max_bytes: size limit for the stored token ids (default: unlimited)
+        :param batch_size: number of new entries to buffer before writing them
+        """
+        self.path = path
+        self.tokenizer = tokenizer
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        # encode() is called from both the parsing thread and the background writer thread
+        self.lock = threading.Lock()
+        # the default rollback journal rather than WAL, which needs shared memory and so is only safe when every process
+        # is on one host, while the cache is meant to be shared by workers on several nodes
+        self.conn = sqlite3.connect(path, timeout=600, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS tokens (
+                    key BLOB PRIMARY KEY, ids BLOB, size INTEGER, last_used INTEGER
+                )
+            """)
+        self.pending = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha256(self.fingerprint + text.encode('utf-8', 'surrogatepass')).digest()[:16]
+
+    def encode(self, text):
+        """returns the token ids of text, from the cache if possible"""
+        key = self.key(text)
+        with self.lock:
+            ids = self.pending.get(key)
+            if ids is None:
+                row = self.conn.execute("SELECT ids FROM tokens WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    ids = row[0]
+            if ids is not None:
+                self.hits += 1
+                self.used.add(key)
+                return array('I', ids).tolist()
+            self.misses += 1
+        token_ids = self.tokenizer.encode(text).ids
+        with self.lock:
+            self.pending[key] = array('I', token_ids).tobytes()
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+        return token_ids
+
+    def _flush(self):
+        now = int(time.time())
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+                ((key, ids, len(ids), now) for key, ids in self.pending.items())
+            )
+            self.conn.executemany("UPDATE tokens SET last_used = ? WHERE key = ?", ((now, key) for key in self.used))
+        self.pending = {}
+        self.used = set()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def evict(self):
+        """deletes least recently used entries until the cache is within max_bytes"""
+        if self.max_bytes is None:
+            return 0
+        with self.lock:
+            total, = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM tokens").fetchone()
+            if total <= self.max_bytes:
+                return 0
+            to_free = total - self.max_bytes
+            keys = []
+            for key, size in self.conn.execute("SELECT key, size FROM tokens ORDER BY last_used"):
+                if to_free <= 0:
+                    break
+                keys.append((key,))
+                to_free -= size
+            with self.conn:
+                self.conn.executemany("DELETE FROM tokens WHERE key = ?", keys)
+            return len(keys)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def print_status(self, prefix="\t"):
+        print(f"{prefix}token cache: {self.hits:_} hits, {self.misses:_} misses ({self.hit_rate:.2%} hit rate)")
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='show the size of a token cache, optionally evicting entries')
+    parser.add_argument('path')
+    parser.add_argument('--max_bytes', type=int, help='evict least recently used entries down to this size')
+    args = parser.parse_args()
+
+    cache = TokenCache(args.path, None, b'', max_bytes=args.max_bytes)
+    print(f"evicted {cache.evict():_} entries")
+    entries, size = cache.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tokens").fetchone()
+    print(f"{entries:_} documents, {size:_} bytes of token ids")
+    cache.close()
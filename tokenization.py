@@ -0,0 +1,41 @@
+from token_cache import TokenCache, tokenizer_fingerprint
+
+DEFAULT_VOCAB_FILE = '/checkpoint/dpf/data/tokenizers/github-py+so_psno-True/vocab.json'
+DEFAULT_MERGES_FILE = '/checkpoint/dpf/data/tokenizers/github-py+so_psno-True/merges.txt'
+
+# ByteLevelBPETokenizers by (vocab file, merges file, split newlines only), so that each process loads a tokenizer once
+# rather than once per site
+_tokenizers = {}
+
+
+def add_tokenizer_args(parser):
+    """adds the arguments read by get_tokenizer and get_token_cache to an argparse parser"""
+    parser.add_argument('--tokenizer_vocab_file', type=str, default=DEFAULT_VOCAB_FILE)
+    parser.add_argument('--tokenizer_merges_file', type=str, default=DEFAULT_MERGES_FILE)
+    parser.add_argument('--no_tokenizer_split_newlines_only', dest='tokenizer_split_newlines_only', action='store_false',
+                        help='pretokenize on whitespace, rather than only on newlines')
+    parser.add_argument('--token_cache', help='SQLite file caching token ids by document hash, reused across runs')
+    parser.add_argument('--token_cache_max_bytes', help='evict least recently used token cache entries down to '
+                                                        'this size when the cache is closed', type=int)
+
+
+def get_tokenizer(args):
+    """the ByteLevelBPETokenizer configured by the add_tokenizer_args arguments, loaded once per process"""
+    key = (args.tokenizer_vocab_file, args.tokenizer_merges_file, args.tokenizer_split_newlines_only)
+    if key not in _tokenizers:
+        from tokenizers import ByteLevelBPETokenizer
+        _tokenizers[key] = ByteLevelBPETokenizer.from_file(
+            args.tokenizer_vocab_file,
+            args.tokenizer_merges_file,
+            pretokenizer_split_newlines_only=args.tokenizer_split_newlines_only,
+        )
+    return _tokenizers[key]
+
+
+def get_token_cache(args, tokenizer):
+    """a TokenCache for tokenizer if --token_cache is given, else None. The caller closes it"""
+    if args.token_cache is None:
+        return None
+    fingerprint = tokenizer_fingerprint(args.tokenizer_vocab_file, args.tokenizer_merges_file,
+                                        pretokenizer_split_newlines_only=args.tokenizer_split_newlines_only)
+    return TokenCache(args.token_cache, tokenizer, fingerprint, max_bytes=args.token_cache_max_bytes)
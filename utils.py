@@ -1,5 +1,12 @@
 import os, re
 import random
+import signal
+import hashlib
+import threading
+from html import unescape
+from contextlib import contextmanager
+import xml.etree.ElementTree as etree
+from collections import defaultdict
 
 class Mean:
     def __init__(self):
@@ -18,6 +25,33 @@ class Mean:
             return self.total / self.count
 
 
+class Record(dict):
+    """attribute dict for a single row, returning None for missing attributes (without inserting them like defaultdict)"""
+    __slots__ = ()
+
+    def __missing__(self, key):
+        return None
+
+
+def iter_records(file, in_format="xml", columns=None):
+    """
+    yields an attribute dict for each row of a posts or comments file
+
+    :param in_format: "xml" or "csv"
+    :param columns: for csv input, the only columns to read (default: all)
+    """
+    if in_format == 'csv':
+        # imported here since csv_reader imports Record from this module
+        from csv_reader import iter_projected_csv
+        yield from iter_projected_csv(file, columns)
+    else:
+        for event, elem in etree.iterparse(file, events=('end',)):
+            if elem.tag == 'row':
+                record = defaultdict(lambda: None, elem.attrib)
+                yield record
+                elem.clear()
+
+
 def header_info(xml_path):
     os.system("head {}".format(xml_path))
 
@@ -70,7 +104,8 @@ def trim_attribs(elem_attribs, attrib_type="question"):
         to_delete = [x for x in elem_attribs.keys() if x not in to_keep]
         [elem_attribs.pop(x, None) for x in to_delete]
         elem_attribs["ParsedAnswers"] = 0
-        elem_attribs["Answers"] = {}
+        # (-score, arrival order, answer attribs) tuples, kept sorted by QA_Pairer.keep_answer
+        elem_attribs["Answers"] = []
     elif attrib_type == "answer":
         to_keep = ['Id', 'Body', 'Score', 'BodyParsed']
         new_dict = {}
@@ -99,7 +134,47 @@ def threshold(lower_bounds, value):
     assert 0 <= disc_threshold < len(lower_bounds)
     return disc_threshold
 
-def make_tagged(tag, inner, attributes={}, insert_newlines=True, attribute_move_probability=None):
+def make_rng(*key, seed=0):
+    """
+    returns a random.Random seeded from seed and key (e.g. site name and question Id). Unlike hash(), the seed doesn't
+    depend on the process, so output is the same however the work is split between processes
+    """
+    digest = hashlib.sha256('\0'.join(str(k) for k in (seed,) + key).encode('utf-8')).digest()
+    return random.Random(int.from_bytes(digest[:8], 'big'))
+
+class ParseTimeout(Exception):
+    pass
+
+@contextmanager
+def time_limit(seconds):
+    """
+    raises ParseTimeout in the with block once it has run for seconds. Uses SIGALRM, so this only interrupts code on
+    the main thread on Unix; elsewhere it does nothing and callers should check the elapsed time themselves.
+    """
+    if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        raise ParseTimeout(f"timed out after {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+html_tag_re = re.compile(r"<[^>]*>")
+
+def strip_html(html):
+    """crude html to text, for posts that take too long to parse with BeautifulSoup"""
+    return unescape(html_tag_re.sub("", html))
+
+def make_tagged(tag, inner, attributes={}, insert_newlines=True, attribute_move_probability=None, rng=None):
+    if rng is None:
+        rng = random
     if attributes:
         attr_strs = [f'{k}={v}' for k, v in attributes.items()]
         if attribute_move_probability is not None:
@@ -107,7 +182,7 @@ def make_tagged(tag, inner, attributes={}, insert_newlines=True, attribute_move_
             begin_attr_strs = []
             end_attr_strs = []
             for x in attr_strs:
-                if random.random() < attribute_move_probability:
+                if rng.random() < attribute_move_probability:
                     end_attr_strs.append(x)
                 else:
                     begin_attr_strs.append(x)
@@ -119,12 +194,12 @@ def make_tagged(tag, inner, attributes={}, insert_newlines=True, attribute_move_
         begin_attr_strs = []
         end_attr_strs = []
     if begin_attr_strs:
-        random.shuffle(begin_attr_strs)
+        rng.shuffle(begin_attr_strs)
         begin_attr_string = f" {' '.join(begin_attr_strs)}"
     else:
         begin_attr_string = ''
     if end_attr_strs:
-        random.shuffle(end_attr_strs)
+        rng.shuffle(end_attr_strs)
         end_attr_string = f" {' '.join(end_attr_strs)}"
     else:
         end_attr_string = ''
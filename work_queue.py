@@ -0,0 +1,271 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+from collections import namedtuple
+
+Task = namedtuple("Task", ["site", "shard", "num_shards", "attempt"])
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue():
+
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        """
+        Queue of (site, shard) tasks in a SQLite file, which any number of workers on any machine that can see the file
+        pull from until it is empty.
+
+        A worker claims a task with a lease, and extends the lease with heartbeats while it works on it (see Lease). If
+        the worker dies, the lease expires and the task is handed to the next worker that asks, up to max_attempts
+        times. Every claim, completion, failure and expired lease is recorded in the events table.
+
+        Claims are made in an immediate transaction, so two workers can never hold the same task. SQLite locking over
+        network filesystems is only as reliable as their fcntl locks; on NFS, prefer a local file served by one node.
+        Leases are compared against each worker's clock, so nodes should keep their clocks in sync; a worker whose lease
+        expires anyway finds out at its next heartbeat and must stop (see Lease.lost).
+
+        :param path: SQLite file, created if it doesn't exist
+        :param lease_seconds: how long a claim lasts without a heartbeat
+        :param max_attempts: number of claims of a task before it is marked failed
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # autocommit, so that claims can BEGIN IMMEDIATE themselves. The default rollback journal is kept, since WAL
+        # mode needs shared memory and so doesn't work across machines
+        self.conn = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                site TEXT, shard INTEGER, num_shards INTEGER, status TEXT, worker TEXT, lease_expires REAL,
+                attempts INTEGER, error TEXT, PRIMARY KEY (site, shard)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                site TEXT, shard INTEGER, worker TEXT, time REAL, event TEXT, error TEXT
+            )
+        """)
+
+    def add_tasks(self, sites, num_shards=None):
+        """
+        adds a task for every shard of every site, leaving existing tasks as they are
+
+        :param num_shards: if None, each site is a single unsharded task (shard 0)
+        """
+        tasks = [(site, shard, num_shards) for site in sites for shard in range(num_shards or 1)]
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, 'pending', NULL, NULL, 0, NULL)", tasks
+            )
+            added = self.conn.total_changes - before
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(self, worker):
+        """
+        :return: a pending task, or one whose lease has expired, now leased to worker, or None if there are none left
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # return tasks with expired leases to the queue, or fail them if they have used up their attempts
+            expired = self.conn.execute(
+                "SELECT site, shard, worker, attempts FROM tasks WHERE status = 'running' AND lease_expires < ?", (now,)
+            ).fetchall()
+            for site, shard, worker_, attempts in expired:
+                self._record(site, shard, worker_, now, "expired", "lease expired")
+                status = "failed" if attempts >= self.max_attempts else "pending"
+                self.conn.execute(
+                    "UPDATE tasks SET status = ?, worker = NULL, lease_expires = NULL, error = 'lease expired' "
+                    "WHERE site = ? AND shard = ?", (status, site, shard)
+                )
+            row = self.conn.execute(
+                "SELECT site, shard, num_shards, attempts FROM tasks WHERE status = 'pending' ORDER BY rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+            site, shard, num_shards, attempts = row
+            self.conn.execute(
+                "UPDATE tasks SET status = 'running', worker = ?, lease_expires = ?, attempts = ? "
+                "WHERE site = ? AND shard = ?", (worker, now + self.lease_seconds, attempts + 1, site, shard)
+            )
+            self._record(site, shard, worker, now, "claimed", None)
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        return Task(site, shard, num_shards, attempts + 1)
+
+    def heartbeat(self, task, worker):
+        """
+        extends worker's lease on task
+
+        :return: False if the lease was lost, e.g. it expired and the task was claimed by another worker
+        """
+        cursor = self.conn.execute(
+            "UPDATE tasks SET lease_expires = ? WHERE site = ? AND shard = ? AND worker = ? AND status = 'running'",
+            (time.time() + self.lease_seconds, task.site, task.shard, worker)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, task, worker):
+        """marks task as done, if worker still holds its lease"""
+        return self._finish(task, worker, "done", None)
+
+    def fail(self, task, worker, error):
+        """returns task to the queue to be retried, or marks it failed if it has used up its attempts"""
+        return self._finish(task, worker, "failed", error)
+
+    def _finish(self, task, worker, outcome, error):
+        now = time.time()
+        if outcome == "failed" and task.attempt < self.max_attempts:
+            status = "pending"
+        else:
+            status = outcome
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.conn.execute(
+                "UPDATE tasks SET status = ?, worker = NULL, lease_expires = NULL, error = ? "
+                "WHERE site = ? AND shard = ? AND worker = ? AND status = 'running'",
+                (status, error, task.site, task.shard, worker)
+            )
+            held = cursor.rowcount == 1
+            self._record(task.site, task.shard, worker, now, outcome if held else f"{outcome} (lease lost)", error)
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        return held
+
+    def _record(self, site, shard, worker, when, event, error):
+        self.conn.execute("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", (site, shard, worker, when, event, error))
+
+    def retry_failed(self):
+        """returns failed tasks to the queue, with their attempts reset"""
+        cursor = self.conn.execute(
+            "UPDATE tasks SET status = 'pending', attempts = 0, error = NULL WHERE status = 'failed'"
+        )
+        return cursor.rowcount
+
+    def counts(self):
+        """Dict[status, number of tasks]"""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    def print_status(self, show_failed=True):
+        counts = self.counts()
+        print('\t'.join(f"{status}: {counts.get(status, 0):_}" for status in ["pending", "running", "done", "failed"]))
+        now = time.time()
+        for site, shard, worker, lease_expires in self.conn.execute(
+                "SELECT site, shard, worker, lease_expires FROM tasks WHERE status = 'running' ORDER BY site, shard"):
+            print(f"\trunning\t{site}\t{shard}\t{worker}\tlease expires in {lease_expires - now:.0f}s")
+        if show_failed:
+            for site, shard, error in self.conn.execute(
+                    "SELECT site, shard, error FROM tasks WHERE status = 'failed' ORDER BY site, shard"):
+                last_line = (error or "").strip().split('\n')[-1]
+                print(f"\tfailed\t{site}\t{shard}\t{last_line}")
+
+    def close(self):
+        self.conn.close()
+
+
+class Lease():
+
+    def __init__(self, queue, task, worker, interval=None):
+        """
+        Context manager that heartbeats worker's lease on task from a background thread while the task runs.
+
+        If a heartbeat finds that the lease was lost, e.g. after a stall or clock skew, the lost event is set. The task
+        must then stop, since it may already have been handed to another worker: pass lost to QA_Pairer(cancel=...),
+        and call check() before publishing any output.
+
+        :param queue: WorkQueue the task was claimed from. The heartbeats use their own connection to its file
+        :param interval: seconds between heartbeats (default: a third of the lease)
+        """
+        self.path = queue.path
+        self.lease_seconds = queue.lease_seconds
+        self.task = task
+        self.worker = worker
+        self.interval = interval if interval is not None else queue.lease_seconds / 3
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        queue = WorkQueue(self.path, lease_seconds=self.lease_seconds)
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    held = queue.heartbeat(self.task, self.worker)
+                except sqlite3.Error as e:
+                    # e.g. the file is briefly unreachable; if the lease expires meanwhile, the next heartbeat says so
+                    print(f"heartbeat for {self.task.site} shard {self.task.shard} failed: {e}")
+                    continue
+                if not held:
+                    print(f"lost the lease on {self.task.site} shard {self.task.shard}")
+                    self.lost.set()
+                    return
+        finally:
+            queue.close()
+
+    def check(self, queue):
+        """raises LeaseLost unless the lease is still held, heartbeating it with queue's connection"""
+        if self.lost.is_set() or not queue.heartbeat(self.task, self.worker):
+            self.lost.set()
+            raise LeaseLost(f"lost the lease on {self.task.site} shard {self.task.shard}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='create and inspect a queue of (site, shard) tasks shared by '
+                                                 'main.py --work_queue workers')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help='add tasks to a queue, creating it if needed')
+    init_parser.add_argument('path', help='SQLite file')
+    init_parser.add_argument('--names', required=True,
+                             help='names of stackexchanges, separated by commas, or "all" for every site in Sites.xml')
+    init_parser.add_argument('--num_shards', type=int, help='split each site into this many tasks')
+    init_parser.add_argument('--mirror', help='with --names all, base URL or local folder to fetch Sites.xml from')
+
+    status_parser = subparsers.add_parser('status', help='print task counts, running tasks and failures')
+    status_parser.add_argument('path')
+
+    retry_parser = subparsers.add_parser('retry', help='return failed tasks to the queue')
+    retry_parser.add_argument('path')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.path)
+    if args.command == 'init':
+        names = [name.strip().lower() for name in args.names.split(',')]
+        if names[0] == "all":
+            from downloader import Stack_Exchange_Downloader
+            names = list(Stack_Exchange_Downloader("all", mirror=args.mirror).sites)
+        added = queue.add_tasks(names, num_shards=args.num_shards)
+        print(f"added {added:_} tasks")
+    elif args.command == 'retry':
+        print(f"returned {queue.retry_failed():_} failed tasks to the queue")
+    queue.print_status()
+    queue.close()
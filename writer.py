@@ -0,0 +1,73 @@
+import queue
+import threading
+
+
+class AsyncWriter():
+
+    _stop = object()
+
+    def __init__(self, write_fn, max_queue_size=1024):
+        """
+        Calls write_fn on a background thread for every item passed to put(), so that compression and disk latency
+        overlap with parsing.
+
+        put() blocks once max_queue_size items are pending, which keeps a slow sink from buffering the whole dump in
+        memory. If write_fn raises, the remaining items are dropped and the exception is re-raised in the calling thread
+        by the next put(), flush() or close().
+
+        :param write_fn: function called with the positional arguments passed to put()
+        :param max_queue_size: maximum number of pending items before put() blocks
+        """
+        self.write_fn = write_fn
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.closed = False
+        self.aborted = False
+        self.thread = threading.Thread(target=self._run, name="AsyncWriter", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._stop:
+                    return
+                if self.error is None and not self.aborted:
+                    self.write_fn(*item)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, *args):
+        assert not self.closed, "put() called on a closed writer"
+        self._raise_if_failed()
+        self.queue.put(args)
+
+    def flush(self):
+        """blocks until every pending item has been written"""
+        self.queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        """writes every pending item and stops the background thread"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(self._stop)
+            self.thread.join()
+        self._raise_if_failed()
+
+    def abort(self):
+        """
+        stops the background thread without writing the pending items or raising its error, e.g. when the caller has
+        failed. Until the thread is stopped it holds a reference to write_fn, and so to everything write_fn is bound to
+        """
+        if not self.closed:
+            self.closed = True
+            self.aborted = True
+            self.queue.put(self._stop)
+            self.thread.join()